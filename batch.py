@@ -0,0 +1,117 @@
+'''Solves every maze photo in a folder, on all cores, and writes one JSON line per photo.
+
+    python batch.py scans/ --output results.jsonl --jobs 8
+'''
+import argparse
+import json
+import os
+import sys
+from multiprocessing import Pool
+from time import perf_counter
+
+import cv2
+
+from helpers import crop_from_points
+from extract_lines import find_lines, find_maze, find_items
+from build_the_maze import Maze
+from maze_solver import astar
+from frame_sources import IMAGE_EXTENSIONS
+
+
+def solve_image(path):
+    '''Runs the vision pipeline and the solver on one photo.
+       Never raises: errors are reported in the result.'''
+    result = {'image': path, 'ok': False, 'timings': {}}
+    timings = result['timings']
+
+    def timed(stage, function, *args):
+        t = perf_counter()
+        value = function(*args)
+        timings[stage] = round((perf_counter()-t)*1000, 3)
+        return value
+
+    try:
+        img = timed('read', cv2.imread, path)
+        if img is None:
+            result['error'] = 'Could not read image'
+            return result
+
+        _, corners = timed('detect', find_maze, img)
+        if corners is None:
+            result['error'] = 'No maze found'
+            return result
+
+        img_cropped_maze, _ = timed('crop', crop_from_points, img, corners)
+        items, item_mask = timed('items', find_items, img_cropped_maze)
+        vlines, hlines = timed('lines', find_lines, img_cropped_maze, item_mask)
+        if not vlines or not hlines:
+            result['error'] = 'No lines found'
+            return result
+
+        def build():
+            maze = Maze(vlines, hlines)
+            maze.get_walkable_grid()
+            maze.build_maze(items)
+            return maze
+        maze = timed('build', build)
+
+        result['grid'] = [''.join(str(value) for value in row) for row in maze.maze_array]
+        result['entrances'] = [[int(y), int(x)] for y, x in maze.entrances]
+        result['items'] = [[int(y), int(x), kind] for (y, x), kind in maze.items]
+
+        if not timed('validate', maze.is_valid):
+            result['error'] = 'Invalid maze'
+            return result
+
+        start = maze.case_array[maze.entrances[0]]
+        end = maze.case_array[maze.entrances[1]]
+        path, distance = timed('solve', astar, maze, start, end)
+        result['path_length'] = int(distance)
+        result['path'] = [[int(y), int(x)] for y, x in (case.position for case in path)]
+        result['ok'] = True
+
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+
+    return result
+
+
+def find_images(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def _quiet():
+    # Maze.is_valid prints why a maze is invalid, the JSON already says so
+    sys.stdout = open(os.devnull, 'w')
+
+
+def run(paths, output, jobs=None):
+    '''Solves paths on a pool of jobs processes, writing results to output as they finish.
+       Returns how many were solved.'''
+    solved = 0
+    with Pool(jobs, initializer=_quiet) as pool:
+        for result in pool.imap_unordered(solve_image, paths):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            solved += result['ok']
+    return solved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Solves a folder of maze photos')
+    parser.add_argument('directory')
+    parser.add_argument('--output', '-o', help='JSON Lines file to write (default: stdout)')
+    parser.add_argument('--jobs', '-j', type=int, help='worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    paths = find_images(args.directory)
+    first = perf_counter()
+    output = open(args.output, 'w') if args.output else sys.stdout
+
+    solved = run(paths, output, args.jobs)
+
+    if args.output:
+        output.close()
+    seconds = perf_counter()-first
+    print(f'{solved}/{len(paths)} solved in {seconds:.2f}s ({len(paths)/seconds:.1f} images/s)', file=sys.stderr)
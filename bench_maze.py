@@ -0,0 +1,104 @@
+'''Times the maze compiler and the solver on generated mazes of growing size, to see where they stop scaling linearly.
+
+    python bench_maze.py --sizes 10 25 50 100 200 --loops 0 0.1
+    python bench_maze.py --sizes 100 500 --entrances 4 --items 0.02
+
+Every stage is timed on the same maze. The exponent column is how the time grows with the
+number of cells since the previous size (1 is linear, 2 quadratic).
+'''
+import argparse
+import json
+from math import log
+from time import perf_counter
+
+import numpy as np
+
+from build_the_maze import Maze
+from maze_generator import generate_maze, maze_lines
+from maze_solver import astar
+
+
+STAGES = ['basic', 'items', 'compress', 'astar']
+
+
+def run_stages(maze_array, cell=10):
+    '''Builds and solves maze_array from its lines, like parse_maze and the game do.
+       Returns the Maze and a dict of stage: seconds'''
+    vlines, hlines, items = maze_lines(maze_array, cell)
+    times = {}
+
+    t = perf_counter()
+    maze = Maze(vlines, hlines)
+    maze.get_walkable_grid()
+    maze.build_basic_maze()
+    times['basic'] = perf_counter()-t
+
+    t = perf_counter()
+    maze.build_items(items)
+    times['items'] = perf_counter()-t
+
+    t = perf_counter()
+    maze.compress_maze(items)
+    times['compress'] = perf_counter()-t
+
+    t = perf_counter()
+    astar(maze, maze.case_array[maze.entrances[0]], maze.case_array[maze.entrances[-1]])
+    times['astar'] = perf_counter()-t
+
+    return maze, times
+
+
+def benchmark(size, loops=0.0, entrances=2, items=0.0, repeat=3, seed=0):
+    '''Best of repeat runs of every stage on a size x size maze.
+       Returns a dict with the maze's size and the times in ms'''
+    maze_array = generate_maze(size, size, loops=loops, entrances=entrances, smol=items/2, big=items/2, rng=seed)
+    best = {stage: np.inf for stage in STAGES}
+    for _ in range(repeat):
+        maze, times = run_stages(maze_array)
+        for stage, seconds in times.items():
+            best[stage] = min(best[stage], seconds*1000)
+    return {'size': size, 'cells': size*size, 'loops': loops, 'entrances': entrances, 'items': items,
+            'junctions': len(maze.non_Cs), **best}
+
+
+def print_results(results):
+    print(f"{'size':>6} {'cells':>8} {'junctions':>9}" + ''.join(f'{stage:>17}' for stage in STAGES))
+    previous = None
+    for r in results:
+        row = f"{r['size']:>6} {r['cells']:>8} {r['junctions']:>9}"
+        for stage in STAGES:
+            if previous is not None and previous[stage] > 0:
+                exponent = log(r[stage]/previous[stage]) / log(r['cells']/previous['cells'])
+                row += f'{r[stage]:>11.2f} ({exponent:>3.1f})'
+            else:
+                row += f'{r[stage]:>11.2f}      '
+        print(row)
+        previous = r
+    print('(ms, best of the repeats; the exponent of the growth since the previous size in brackets)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maze compiler and solver scaling benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 25, 50, 100, 200],
+                        help='rows (and columns) of the mazes')
+    parser.add_argument('--loops', type=float, nargs='+', default=[0.0],
+                        help='fractions of inner walls knocked down (0 is a perfect maze), each one a run')
+    parser.add_argument('--entrances', type=int, default=2)
+    parser.add_argument('--items', type=float, default=0.02, help='fraction of cells with a slime or a dog')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for loops in args.loops:
+        loop_results = [benchmark(size, loops, args.entrances, args.items, args.repeat, args.seed)
+                        for size in args.sizes]
+        print(f'loops: {loops}')
+        print_results(loop_results)
+        print()
+        results += loop_results
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
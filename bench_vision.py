@@ -0,0 +1,159 @@
+'''Times every maze_boi stage on synthetic frames and checks the parsed maze against ground truth.
+
+    python bench_vision.py --frames 20 --resolutions 480p 1080p 4k
+    python bench_vision.py --lines hough projection    # compare line extractors on the same frames
+    python bench_vision.py --item-methods contours components --items 12 12
+    python bench_vision.py --workspaces 0 640    # crop at the size on screen vs into a 640 pixel workspace
+'''
+import argparse
+import json
+from time import perf_counter
+
+import numpy as np
+import cv2
+
+from helpers import crop_from_points, perspective_transform, blend_non_transparent, Workspace
+from extract_lines import find_lines, find_maze, find_items
+from build_the_maze import Maze
+from synthetic import RESOLUTIONS, random_maze, make_frame
+from preprocessing import Preprocessor
+
+
+preprocessor = Preprocessor()
+
+
+STAGES = ['detect', 'crop', 'items', 'lines', 'build', 'validate', 'overlay', 'warp_back', 'blend']
+
+
+def run_pipeline(frame, lines='hough', item_method='contours', workspace=None):
+    '''Same stages as maze_boi while looking for a maze, timed one by one.
+       lines and item_method are the find_lines and find_items methods,
+       workspace the Workspace to crop the maze into (None for its size on screen).
+       Returns the parsed Maze (or None) and a dict of stage: seconds.'''
+    times = {}
+
+    t = perf_counter()
+    _, corners = find_maze(frame, preprocessor.blur(frame, 'frame'))
+    times['detect'] = perf_counter()-t
+    if corners is None:
+        return None, times
+
+    t = perf_counter()
+    img_cropped_maze, transformation = crop_from_points(frame, corners, workspace=workspace)
+    transformation_matrix = np.linalg.pinv(transformation['matrix'])
+    times['crop'] = perf_counter()-t
+
+    t = perf_counter()
+    blurred = preprocessor.blur(img_cropped_maze, 'crop')
+    items, item_mask = find_items(img_cropped_maze, blurred, method=item_method)
+    times['items'] = perf_counter()-t
+
+    t = perf_counter()
+    vlines, hlines = find_lines(img_cropped_maze, item_mask, method=lines, blurred=blurred)
+    times['lines'] = perf_counter()-t
+    if not vlines or not hlines:
+        return None, times
+
+    t = perf_counter()
+    maze = Maze(vlines, hlines)
+    maze.get_walkable_grid()
+    maze.build_maze(items)
+    times['build'] = perf_counter()-t
+
+    t = perf_counter()
+    valid = maze.is_valid()
+    times['validate'] = perf_counter()-t
+
+    t = perf_counter()
+    layer, mask = maze.overlay(img_cropped_maze.shape)
+    cv2.copyTo(layer, mask, img_cropped_maze)
+    times['overlay'] = perf_counter()-t
+
+    t = perf_counter()
+    img_maze_final = perspective_transform(img_cropped_maze, transformation_matrix,
+                                           transformation['original_shape'], frame.shape)
+    times['warp_back'] = perf_counter()-t
+
+    t = perf_counter()
+    blend_non_transparent(frame, img_maze_final)
+    times['blend'] = perf_counter()-t
+
+    return (maze if valid else None), times
+
+
+def benchmark(resolution, frames=10, rows=10, cols=10, smol=2, big=2, seed=0, lines='hough',
+              item_method='contours', workspace=None):
+    '''Runs frames synthetic frames of one resolution through the pipeline.
+       workspace is the long side of the Workspace to crop into (None for no workspace).
+       Returns accuracy (parsed maze_array equals ground truth) and per stage timings in ms.'''
+    rng = np.random.default_rng(seed)
+    samples = {stage: [] for stage in STAGES}
+    correct = 0
+    crop_workspace = Workspace(workspace) if workspace else None
+    for _ in range(frames):
+        truth = random_maze(rows, cols, smol=smol, big=big, rng=rng)
+        frame, _ = make_frame(truth, RESOLUTIONS[resolution], rng=rng)
+
+        maze, times = run_pipeline(frame, lines, item_method, crop_workspace)
+        for stage, seconds in times.items():
+            samples[stage].append(seconds*1000)
+        if maze is not None and np.array_equal(maze.maze_array, truth):
+            correct += 1
+
+    result = {'resolution': resolution, 'lines': lines, 'item_method': item_method, 'workspace': workspace,
+              'frames': frames, 'accuracy': correct/frames}
+    for stage, values in samples.items():
+        if values:
+            result[stage] = {'p50': float(np.percentile(values, 50)),
+                             'p95': float(np.percentile(values, 95))}
+    return result
+
+
+def print_results(results):
+    header = f"{'stage':<11}" + ''.join(f"{r['resolution']:>18}" for r in results)
+    print(header)
+    print(f"{'accuracy':<11}" + ''.join(f"{r['accuracy']*100:>17.0f}%" for r in results))
+    for stage in STAGES:
+        row = f'{stage:<11}'
+        for r in results:
+            if stage in r:
+                row += f"{r[stage]['p50']:>9.2f}/{r[stage]['p95']:<8.2f}"
+            else:
+                row += f"{'-':>18}"
+        print(row)
+    print('(ms, p50/p95)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vision pipeline benchmark on synthetic frames')
+    parser.add_argument('--frames', type=int, default=10, help='frames per resolution')
+    parser.add_argument('--resolutions', nargs='+', default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    parser.add_argument('--size', type=int, nargs=2, default=(10, 10), metavar=('ROWS', 'COLS'),
+                        help='maze size in cells')
+    parser.add_argument('--items', type=int, nargs=2, default=(2, 2), metavar=('SLIMES', 'DOGS'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--lines', nargs='+', default=['hough'], choices=['hough', 'projection'],
+                        help='find_lines methods to run (each gets the same frames)')
+    parser.add_argument('--item-methods', nargs='+', default=['contours'], choices=['contours', 'components'],
+                        help='find_items methods to run (each gets the same frames)')
+    parser.add_argument('--workspaces', type=int, nargs='+', default=[0],
+                        help='long sides of the workspace to crop the maze into (0 crops it at its size on screen)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for method in args.lines:
+        for item_method in args.item_methods:
+            for workspace in args.workspaces:
+                method_results = [benchmark(resolution, args.frames, *args.size, *args.items,
+                                            seed=args.seed, lines=method, item_method=item_method,
+                                            workspace=workspace)
+                                  for resolution in args.resolutions]
+                print(f'find_lines: {method}, find_items: {item_method}, workspace: {workspace or None}')
+                print_results(method_results)
+                print()
+                results += method_results
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
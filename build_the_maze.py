@@ -1,9 +1,16 @@
+from threading import Lock
+
 import numpy as np
 import cv2
-import pickle
 
 from maze_solver import astar
-from game import Master
+
+
+# Version of the files written by save_maze
+MAZE_FORMAT = 1
+
+# Mazes with more than this fraction of their cells changed are built again from scratch
+RECOMPRESS_LIMIT = 0.2
 
 
 class Maze:
@@ -45,21 +52,15 @@ class Maze:
     def real_position(self, y, x):
         '''Returns y and x values for coordinates in the maze
            Returns None, None if they are outside the maze'''
-        try:
-            if y % 2 == 0:
-                realy = self.hlines[y//2].position
-            else:
-                realy = self.ygrid[y//2]
-            if x % 2 == 0:
-                realx = self.vlines[x//2].position
-            else:
-                realx = self.xgrid[x//2]
-
-        except IndexError:
-            # print(f'real_position out of range: {y, x}')
-            return None, None
+        return self.geometry.position(y, x)
 
-        return realy, realx
+    @property
+    def geometry(self):
+        'Where each row and column of maze_array is in the image (made the first time it is needed)'
+        geometry = self.__dict__.get('_geometry')
+        if geometry is None:
+            geometry = self._geometry = MazeGeometry(self)
+        return geometry
 
     def get_walkable_grid(self):
         # Lists of x and y positions for the grid
@@ -89,28 +90,39 @@ class Maze:
                         else:
                             self.maze_array[y,x] = 7
 
-    def build_maze(self, items, key=None):
-        game = Master.instance()
-
+    def build_maze(self, items, key=None, session=None):
+        '''session is the game Session whose mazes we reuse (None to only use the shared cache)'''
         # Making a binary maze (1 is wall 0 is walkable)
         self.build_basic_maze()
         self.build_items(items)
 
-        # Turn out binary maze into a string
+        # Turn out binary maze into a key (its shape and raw bytes)
         # Save it in a dictionary that points to the finished maze (self.case_array)
         # So if we are trying to build the same maze, we don't have to recreate it
-        np.set_printoptions(threshold=np.inf)
-        binary_maze_string = np.array2string(self.maze_array)
+        binary_maze_string = (self.maze_array.shape, self.maze_array.tobytes())
+
+        built_mazes = session.built_mazes if session is not None else dict()
+        maze_cache = session.maze_cache if session is not None else shared_maze_cache()
 
-        if binary_maze_string in game.built_mazes.keys():
-            self.case_array, self.entrances, self.items = game.built_mazes[binary_maze_string]
+        if binary_maze_string in built_mazes:
+            self.case_array, self.entrances, self.items = built_mazes[binary_maze_string]
         else:
-            self.compress_maze(items)
-            game.built_mazes[binary_maze_string] = (self.case_array, self.entrances, self.items)
+            # Another session may have built it already, we get our own copy of its cases
+            built = maze_cache.get(binary_maze_string)
+            if built is not None:
+                self.case_array, self.entrances, self.items = built
+            elif not self.recompress_last(session):
+                self.compress_maze(items)
+                maze_cache.put(binary_maze_string, self.case_array, self.entrances, self.items)
+            built_mazes[binary_maze_string] = (self.case_array, self.entrances, self.items)
+
+        if session is not None:
+            session.last_built = (binary_maze_string, self.maze_array, self.case_array, self.entrances)
 
         if key is not None:
             if key == ord('q'):
-                print(binary_maze_string)
+                np.set_printoptions(threshold=np.inf)
+                print(self.maze_array)
                 for e in self.entrances:
                     print(self.real_position(e[0], e[1]))
                 print(self.entrances)
@@ -151,55 +163,9 @@ class Maze:
     def compress_maze(self, items):
         # Turn all the 0s into Case objects and add their paths
         # Afterwards we can loop through those paths and remove corridors
-        h = self.maze_array.shape[0]-1
-        w = self.maze_array.shape[1]-1
-        self.case_array = np.zeros_like(self.maze_array, dtype=np.object)
-
-        # Look for entrances in y=0, y=h, x=0, x=w
-        def get_entrances():
-            entrances = []
-            for x, case in enumerate(self.maze_array[0, :]):
-                if case == 0:
-                    entrances.append((0,x))
-            for x, case in enumerate(self.maze_array[h, :]):
-                if case == 0:
-                    entrances.append((h,x))
-            for y, case in enumerate(self.maze_array[:, 0]):
-                if case == 0:
-                    entrances.append((y,0))
-            for y, case in enumerate(self.maze_array[:, w]):
-                if case == 0:
-                    entrances.append((y,w))
-            return entrances
-
-        def nearby_squares(y, x):
-            paths = []
-            corridor = False
-            verts = 0
-            hors = 0
-            if y > 0:
-                if self.maze_array[y-1, x] != 1:
-                    verts += 1
-                    paths.append((y-1, x))
-            if y < h:
-                if self.maze_array[y+1, x] != 1:
-                    verts += 1
-                    paths.append((y+1, x))
-            if x > 0:
-                if self.maze_array[y, x-1] != 1:
-                    hors += 1
-                    paths.append((y, x-1))
-            if x < w:
-                if self.maze_array[y, x+1] != 1:
-                    hors += 1
-                    paths.append((y, x+1))
-
-            if (hors == 2 and verts == 0) or (verts == 2 and hors == 0):
-                corridor = True
-
-            return paths, corridor
-
-        self.entrances = get_entrances()
+        self.case_array = np.zeros_like(self.maze_array, dtype=object)
+
+        self.entrances = self.find_entrances()
 
         if not self.entrances:
             return None
@@ -211,7 +177,7 @@ class Maze:
                 value = case
                 if value != 1:
                     self.case_array[y,x] = Case(value, (y,x))
-                    nearbys, corridor = nearby_squares(y, x)
+                    nearbys, corridor = self.find_nearby_squares(y, x)
                     # Because items are not corridors
                     if value == 0:
                         self.case_array[y,x].corridor = corridor
@@ -227,39 +193,164 @@ class Maze:
         # corridors have case.corridor = True
         # and they also have each a list of their nearby squares
 
-        def get_to_non_c(prevcase, currentpos):
-            currentcase = self.case_array[currentpos]
-            distance = 1
-            while currentcase.corridor is True:
-                distance += 1
-                # if it's a corridor, just look in its path that isn't (prev.y, prev.x)
-                # counter = 0
-                for nearby in currentcase.nearby_squares:
-                    # counter +=1
-                    if nearby == (prevcase.position[0], prevcase.position[1]):
-                        continue
-                    else:
-                        break
-                # print(f'looped {counter} times, shoudl have looped {len(currentcase.nearby_squares)} times')
-                # nearby is the (y, x) of the next square we wanna go to
-                prevcase = currentcase
-                currentcase = self.case_array[nearby]
-
-            return currentcase, distance
-
         # So now we craate paths between all the non-Cs and check their distances
         for dude in non_Cs:
             # check for all its nearby squares, when we reach a non-corridor, set our path to it & distance
             for nearby in dude.nearby_squares:
-                non_c, distance = get_to_non_c(dude, nearby)
+                non_c, distance = self.walk_corridor(dude, nearby)
                 dude.add_path(non_c, distance)
 
         self.non_Cs = non_Cs
 
+    def recompress_last(self, session):
+        '''Builds this maze by patching the last one session built, when someone is drawing on the maze
+           and only a few walls changed. Returns whether it could'''
+        if session is None or session.last_built is None:
+            return False
+        last_string, last_maze_array, case_array, entrances = session.last_built
+
+        # The last maze may still be in use (by the game, a parse result or built_mazes),
+        # so it is patched on a copy of its cases
+        return self.recompress_maze(last_maze_array, copy_cases(case_array), entrances)
+
+    def recompress_maze(self, old_maze_array, case_array, old_entrances):
+        '''Turns case_array (what compress_maze built for old_maze_array) into what it would build
+           for self.maze_array, redoing only the cases around the cells that changed
+           and the paths that go through them. Changes case_array in place.
+           Returns False, without touching it, if the mazes are too different for it to be worth it'''
+        if old_maze_array.shape != self.maze_array.shape or not old_entrances:
+            return False
+        changed = np.argwhere(old_maze_array != self.maze_array)
+        if len(changed) > RECOMPRESS_LIMIT*self.maze_array.size:
+            return False
+        entrances = self.find_entrances()
+        if not entrances:
+            return False
+
+        # Whether a case is a corridor (and where it leads) depends on the squares next to it
+        h, w = self.maze_array.shape
+        touched = set()
+        for y, x in changed.tolist():
+            for ny, nx in ((y, x), (y-1, x), (y+1, x), (y, x-1), (y, x+1)):
+                if 0 <= ny < h and 0 <= nx < w:
+                    touched.add((ny, nx))
+
+        # Every non-corridor whose paths went through the touched squares, found before changing them
+        self.case_array = case_array
+        redo = set()
+        for position in touched:
+            case = case_array[position]
+            if isinstance(case, Case):
+                for nearby in case.nearby_squares:
+                    non_c, distance = self.walk_corridor(case, nearby)
+                    redo.add(non_c.position)
+
+        for position in touched:
+            value = self.maze_array[position]
+            if value == 1:
+                case_array[position] = 0
+                continue
+            case = case_array[position]
+            if not isinstance(case, Case):
+                case = case_array[position] = Case(value, position)
+            nearbys, corridor = self.find_nearby_squares(*position)
+            case.value = value
+            # Because items are not corridors
+            case.corridor = corridor if value == 0 else False
+            case.entrance = False
+            case.nearby_squares = nearbys
+            redo.add(position)
+
+        for entrance in old_entrances:
+            if isinstance(case_array[entrance], Case):
+                case_array[entrance].entrance = False
+        for entrance in entrances:
+            case_array[entrance].entrance = True
+
+        for position in redo:
+            case = case_array[position]
+            if not isinstance(case, Case):
+                continue
+            case.paths = []
+            if case.corridor is False:
+                for nearby in case.nearby_squares:
+                    non_c, distance = self.walk_corridor(case, nearby)
+                    case.add_path(non_c, distance)
+
+        self.entrances = entrances
+        return True
+
+    # Look for entrances in y=0, y=h, x=0, x=w
+    def find_entrances(self):
+        h = self.maze_array.shape[0]-1
+        w = self.maze_array.shape[1]-1
+        entrances = []
+        for x, case in enumerate(self.maze_array[0, :]):
+            if case == 0:
+                entrances.append((0,x))
+        for x, case in enumerate(self.maze_array[h, :]):
+            if case == 0:
+                entrances.append((h,x))
+        for y, case in enumerate(self.maze_array[:, 0]):
+            if case == 0:
+                entrances.append((y,0))
+        for y, case in enumerate(self.maze_array[:, w]):
+            if case == 0:
+                entrances.append((y,w))
+        return entrances
+
+    def find_nearby_squares(self, y, x):
+        'The walkable squares next to (y, x), and whether it is a straight corridor'
+        h = self.maze_array.shape[0]-1
+        w = self.maze_array.shape[1]-1
+        paths = []
+        corridor = False
+        verts = 0
+        hors = 0
+        if y > 0:
+            if self.maze_array[y-1, x] != 1:
+                verts += 1
+                paths.append((y-1, x))
+        if y < h:
+            if self.maze_array[y+1, x] != 1:
+                verts += 1
+                paths.append((y+1, x))
+        if x > 0:
+            if self.maze_array[y, x-1] != 1:
+                hors += 1
+                paths.append((y, x-1))
+        if x < w:
+            if self.maze_array[y, x+1] != 1:
+                hors += 1
+                paths.append((y, x+1))
+
+        if (hors == 2 and verts == 0) or (verts == 2 and hors == 0):
+            corridor = True
+
+        return paths, corridor
+
+    def walk_corridor(self, prevcase, currentpos):
+        '''Goes from prevcase through currentpos along the corridor until it reaches a non-corridor.
+           Returns that Case and how far it is'''
+        currentcase = self.case_array[currentpos]
+        distance = 1
+        while currentcase.corridor is True:
+            distance += 1
+            # if it's a corridor, just look in its path that isn't (prev.y, prev.x)
+            for nearby in currentcase.nearby_squares:
+                if nearby == (prevcase.position[0], prevcase.position[1]):
+                    continue
+                else:
+                    break
+            # nearby is the (y, x) of the next square we wanna go to
+            prevcase = currentcase
+            currentcase = self.case_array[nearby]
+
+        return currentcase, distance
+
     # For testing
-    def pickle(self):
-        with open('pickled_maze', 'wb') as f:
-            pickle.dump(self, f)
+    def save(self, path='maze.npz'):
+        save_maze(self, path)
 
     def test_path(self):
         start = self.case_array[self.entrances[0]]
@@ -300,15 +391,108 @@ class Maze:
         for hline in self.hlines:
             hline.draw_line(image)
 
-    def draw_items(self, image):
+    def draw_items(self, image, ys=None, xs=None):
+        'ys, xs: where the rows and columns of maze_array are in image (the geometry as it is if None)'
         for item in self.items:
-            y, x = self.real_position(item[0][0], item[0][1])
+            if ys is None:
+                y, x = self.real_position(item[0][0], item[0][1])
+            else:
+                y, x = int(ys[item[0][0]]), int(xs[item[0][1]])
             if None not in (y, x):
                 if item[1] == 'smol':
                     cv2.circle(image, (x, y), 2, (255, 0, 0), thickness=-1, lineType=8, shift=0)
                 else:
                     cv2.circle(image, (x, y), 2, (0, 255, 0), thickness=-1, lineType=8, shift=0)
 
+    def crop_shape(self):
+        'Height and width of the cropped image the maze was parsed from (lines span the whole crop)'
+        return len(self.vlines[0].array), len(self.hlines[0].array)
+
+    def overlay(self, shape):
+        '''The walls and items on a black layer of shape (h, w), and a mask of where they are.
+           Drawn once per size, from the lines and geometry rescaled to it (only the size
+           the maze was parsed at and the latest other size are kept)'''
+        h, w = shape[0], shape[1]
+        overlays = getattr(self, '_overlays', None)
+        if overlays is None:
+            overlays = self._overlays = dict()
+        if (h, w) in overlays:
+            return overlays[(h, w)]
+
+        crop_shape = self.crop_shape()
+        if (h, w) != crop_shape:
+            # Only keep the latest other size
+            for size in list(overlays):
+                if size != crop_shape:
+                    del overlays[size]
+
+        # Resizing a drawn layer would drop 1 pixel walls, so lines are moved to where
+        # they are at this size (like the geometry does) and stretched along their length
+        ys, xs = self.geometry.scaled(h/crop_shape[0], w/crop_shape[1])
+        layer = np.zeros((h, w, 3), dtype=np.uint8)
+        # Every wall pixel at once instead of a mask per line
+        walls = np.uint8(np.array([vline.array for vline in self.vlines]) != 0)
+        if h != crop_shape[0]:
+            walls = cv2.resize(walls, (h, len(walls)), interpolation=cv2.INTER_NEAREST)
+        lines, line_ys = np.nonzero(walls)
+        layer[line_ys, xs[0::2][lines]] = (0, 0, 255)
+        walls = np.uint8(np.array([hline.array for hline in self.hlines]) != 0)
+        if w != crop_shape[1]:
+            walls = cv2.resize(walls, (w, len(walls)), interpolation=cv2.INTER_NEAREST)
+        lines, line_xs = np.nonzero(walls)
+        layer[ys[0::2][lines], line_xs] = (0, 0, 255)
+        self.draw_items(layer, ys, xs)
+        blue, green, red = cv2.split(layer)
+        _, mask = cv2.threshold(cv2.bitwise_or(cv2.bitwise_or(blue, green), red), 0, 1, cv2.THRESH_BINARY)
+        overlays[(h, w)] = layer, mask
+        return overlays[(h, w)]
+
+
+class MazeGeometry:
+    '''Pixel positions of every row (ys) and column (xs) of maze_array:
+       even ones are lines, odd ones the middle of the grid between them.
+       Made from the lines as parsed, and rescaled as a whole when the crop changes size'''
+    def __init__(self, maze):
+        self.original_ys = self.interleave([line.position for line in maze.hlines], maze.ygrid)
+        self.original_xs = self.interleave([line.position for line in maze.vlines], maze.xgrid)
+        self.scale = None
+        self.rescale(1, 1)
+
+    @staticmethod
+    def interleave(lines, grid):
+        positions = np.empty(len(lines)+len(grid), dtype=np.float64)
+        positions[0::2] = lines
+        positions[1::2] = grid
+        return positions
+
+    def rescale(self, h_proportion, w_proportion):
+        'Moves everything to a crop h_proportion/w_proportion times the size of the parsed one'
+        if self.scale == (h_proportion, w_proportion):
+            return
+        self.scale = (h_proportion, w_proportion)
+        self.ys, self.xs = self.scaled(h_proportion, w_proportion)
+        # Python lists are faster than arrays for looking up one position at a time
+        self.ys_list = self.ys.tolist()
+        self.xs_list = self.xs.tolist()
+        # Smallest distance between two lines, units are sized to fit it
+        steps = np.concatenate([np.diff(self.ys[0::2]), np.diff(self.xs[0::2])])
+        self.min_cell = int(steps.min()) if len(steps) else np.inf
+
+    def scaled(self, h_proportion, w_proportion):
+        'The ys and xs of a crop h_proportion/w_proportion times the size of the parsed one (without moving to it)'
+        return (np.rint(self.original_ys*h_proportion).astype(np.intp),
+                np.rint(self.original_xs*w_proportion).astype(np.intp))
+
+    def position(self, y, x):
+        '(y, x) in the image of maze_array[y, x], or (None, None) if it is outside the maze'
+        if 0 <= y < len(self.ys_list) and 0 <= x < len(self.xs_list):
+            return self.ys_list[y], self.xs_list[x]
+        return None, None
+
+    def positions(self, ys, xs):
+        'position() for arrays of coordinates (all inside the maze)'
+        return self.ys[ys], self.xs[xs]
+
 
 class Line:
     def __init__(self, array, position, kind):
@@ -320,13 +504,11 @@ class Line:
         return str(self.position)
 
     def draw_line(self, image):
-        mask = np.zeros(shape=(image.shape[0], image.shape[1]))
+        wall = self.array.astype(bool)
         if self.kind == 'v':
-            mask[:, self.position] = self.array
-            image[mask == True] = (0, 0, 255)
+            image[:, self.position][wall] = (0, 0, 255)
         if self.kind == 'h':
-            mask[self.position, :] = self.array
-            image[mask == True] = (0, 0, 255)
+            image[self.position, :][wall] = (0, 0, 255)
 
 
 class Case:
@@ -367,3 +549,133 @@ class Case:
 
     def add_nearby_square(self, pos):
         self.nearby_squares.append(pos)
+
+
+def copy_cases(case_array):
+    '''New Case objects with the same values and paths as case_array.
+       astar writes on the cases it walks, so each session needs its own'''
+    copied = np.zeros_like(case_array, dtype=object)
+    cases = [case for case in case_array.flat if isinstance(case, Case)]
+    for case in cases:
+        copy = Case(case.value, case.position)
+        copy.corridor = case.corridor
+        copy.entrance = case.entrance
+        copy.nearby_squares = list(case.nearby_squares)
+        copied[case.position] = copy
+    for case in cases:
+        copied[case.position].paths = [(copied[other.position], distance) for other, distance in case.paths]
+    return copied
+
+
+# Order of the bits in the nearby squares of a saved case, same order as find_nearby_squares
+NEARBY_STEPS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+ITEM_KINDS = ('smol', 'big')
+
+
+def save_maze(maze, path):
+    '''Writes a built maze to an .npz file: maze_array, the lines and grid, entrances, items and the case graph.
+       Cases are rows of (y, x, corridor, entrance, nearby squares bits, number of paths),
+       paths are rows of (index of the case it leads to, distance), in case order'''
+    cases = [case for case in maze.case_array.flat if isinstance(case, Case)]
+    index = {case.position: i for i, case in enumerate(cases)}
+
+    case_rows = []
+    for case in cases:
+        y, x = case.position
+        nearby = sum(1 << bit for bit, (dy, dx) in enumerate(NEARBY_STEPS) if (y+dy, x+dx) in case.nearby_squares)
+        case_rows.append((y, x, case.corridor, case.entrance, nearby, len(case.paths)))
+    paths = [(index[other.position], distance) for case in cases for other, distance in case.paths]
+
+    np.savez_compressed(
+        path,
+        version=MAZE_FORMAT,
+        maze_array=maze.maze_array,
+        line_positions=np.array([line.position for line in maze.vlines+maze.hlines], dtype=np.int32),
+        vline_arrays=np.array([line.array for line in maze.vlines], dtype=bool),
+        hline_arrays=np.array([line.array for line in maze.hlines], dtype=bool),
+        grid=np.array(maze.xgrid+maze.ygrid, dtype=np.int32),
+        entrances=np.array(maze.entrances, dtype=np.int32).reshape(-1, 2),
+        items=np.array([(y, x, ITEM_KINDS.index(kind)) for (y, x), kind in maze.items], dtype=np.int32).reshape(-1, 3),
+        cases=np.array(case_rows, dtype=np.int32).reshape(-1, 6),
+        paths=np.array(paths, dtype=np.int32).reshape(-1, 2))
+
+
+def load_maze(path):
+    '''The Maze saved in path by save_maze, ready to play or solve.
+       The format is for size (7 KB instead of ~100 KB pickled for a 41x41 maze) and versioning,
+       not speed: rebuilding the Case objects makes it a bit slower to load than a pickle'''
+    with np.load(path) as data:
+        data = dict(data)
+    if int(data['version']) != MAZE_FORMAT:
+        raise ValueError(f"{path} is maze format {int(data['version'])}, expected {MAZE_FORMAT}")
+
+    vline_arrays, hline_arrays = data['vline_arrays'], data['hline_arrays']
+    positions = data['line_positions'].tolist()
+    vlines = [Line(array, position, 'v') for array, position in zip(vline_arrays, positions)]
+    hlines = [Line(array, position, 'h') for array, position in zip(hline_arrays, positions[len(vlines):])]
+    maze = Maze(vlines, hlines)
+    grid = data['grid'].tolist()
+    maze.xgrid, maze.ygrid = grid[:len(vlines)-1], grid[len(vlines)-1:]
+    maze.maze_array = data['maze_array']
+    maze.entrances = [(y, x) for y, x in data['entrances'].tolist()]
+    maze.items = [((y, x), ITEM_KINDS[kind]) for y, x, kind in data['items'].tolist()]
+
+    # The steps to the nearby squares of each combination of bits
+    steps = [[step for bit, step in enumerate(NEARBY_STEPS) if bits >> bit & 1] for bits in range(16)]
+    case_rows = data['cases']
+    ys, xs = case_rows[:, 0], case_rows[:, 1]
+    positions = list(zip(ys.tolist(), xs.tolist()))
+    cases = list(map(Case, maze.maze_array[ys, xs].tolist(), positions))
+    # Cases start as neither
+    for i in np.flatnonzero(case_rows[:, 2]).tolist():
+        cases[i].corridor = True
+    for i in np.flatnonzero(case_rows[:, 3]).tolist():
+        cases[i].entrance = True
+    for case, (y, x), nearby in zip(cases, positions, case_rows[:, 4].tolist()):
+        case.nearby_squares = [(y+dy, x+dx) for dy, dx in steps[nearby]]
+
+    paths = [(cases[target], distance) for target, distance in data['paths'].tolist()]
+    start = 0
+    for case, count in zip(cases, case_rows[:, 5].tolist()):
+        case.paths = paths[start:start+count]
+        start += count
+
+    maze.case_array = np.zeros(maze.maze_array.shape, dtype=object)
+    case_objects = np.empty(len(cases), dtype=object)
+    case_objects[:] = cases
+    maze.case_array[ys, xs] = case_objects
+    maze.non_Cs = [case for case in cases if not case.corridor]
+    return maze
+
+
+class MazeCache:
+    '''Built mazes (case_array, entrances, items) by their binary maze key, shared by every session.
+       The cases stored here are never handed out, get() returns a copy of them'''
+    def __init__(self):
+        self.built_mazes = dict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.built_mazes)
+
+    def get(self, binary_maze_string):
+        with self.lock:
+            built = self.built_mazes.get(binary_maze_string)
+        if built is None:
+            return None
+        case_array, entrances, items = built
+        return copy_cases(case_array), list(entrances), list(items)
+
+    def put(self, binary_maze_string, case_array, entrances, items):
+        # The builder keeps using (and walking) its cases, so we keep a copy
+        built = (copy_cases(case_array), list(entrances), list(items))
+        with self.lock:
+            self.built_mazes.setdefault(binary_maze_string, built)
+
+
+_maze_cache = MazeCache()
+
+
+def shared_maze_cache():
+    'The MazeCache of this process'
+    return _maze_cache
@@ -1,27 +1,120 @@
 from __future__ import print_function
+import argparse
+from time import perf_counter
+# For the time to the first frame (on a kiosk that's most of the wait after a reboot)
+started = perf_counter()
+
 import cv2
 
-from image_parsing import maze_boi
+from image_parsing import maze_boi, maze_boi_multi, ParseWorker
+from frame_sources import open_source, VideoSink
+from game import Session
+from recording import Recorder
+from governor import Governor
+from helpers import Workspace
+from timers import timers
+
+
+parser = argparse.ArgumentParser(description='Plays hazymaze on a camera, a video or a folder of images')
+parser.add_argument('--camera', type=int, default=0, help='camera index (default 0)')
+parser.add_argument('--video', help='read frames from this video file instead of the camera')
+parser.add_argument('--images', help='read frames from the images in this folder instead of the camera')
+parser.add_argument('--fps', type=float, default=30.0, help='frame rate for --images')
+parser.add_argument('--fast', action='store_true', help='process recordings as fast as possible instead of in real time')
+parser.add_argument('--loop', action='store_true', help='start the recording over when it ends')
+parser.add_argument('--frames', type=int, help='stop after this many frames')
+parser.add_argument('--output', help='write the output frames to this video file')
+parser.add_argument('--headless', action='store_true', help="don't open any windows")
+parser.add_argument('--multi', action='store_true', help='play every maze in the frame, not just the biggest')
+parser.add_argument('--start-at', type=int, help='press space on this frame (to play without a keyboard)')
+parser.add_argument('--record', help='write every frame to this recording (replacing it), for recording.py to replay (not with --multi)')
+parser.add_argument('--target-fps', type=float,
+                    help='lower the quality when frames take longer than this frame rate allows (not with --multi)')
+parser.add_argument('--workspace', type=int,
+                    help='warp the maze into this many pixels (long side) at most, whatever its size on screen (not with --multi)')
+parser.add_argument('--parse-thread', action='store_true',
+                    help='parse the maze on another thread, so the frames keep coming while looking for one (not with --multi)')
+parser.add_argument('--memory', action='store_true',
+                    help='measure what every stage allocates (with tracemalloc, a lot slower) and print it at the end')
+args = parser.parse_args()
+if args.multi and (args.record or args.target_fps or args.workspace or args.parse_thread):
+    parser.error('--record, --target-fps, --workspace and --parse-thread only work on the single maze of maze_boi')
+
+session = None
+if args.record or args.target_fps or args.workspace or args.parse_thread:
+    session = Session()
+if args.record:
+    session.recorder = Recorder(args.record)
+if args.target_fps:
+    session.governor = Governor(1000/args.target_fps)
+if args.workspace:
+    session.workspace = Workspace(args.workspace)
+if args.parse_thread:
+    session.parse_worker = ParseWorker(session)
+
+imported = perf_counter()
+if args.memory:
+    timers.track_memory()
+source = open_source(video=args.video, images=args.images, camera=args.camera, loop=args.loop, fps=args.fps)
+sink = VideoSink(args.output, fps=source.fps) if args.output else None
+
+if not args.headless:
+    cv2.startWindowThread()
+
+count = 0
+first = perf_counter()
+for img in source.frames(paced=not args.fast, limit=args.frames):
+    if args.headless:
+        key = -1
+    else:
+        key = cv2.waitKey(10)
+        if key == 27:
+            break
+    if count == args.start_at:
+        key = 32    # Spacebar
 
-# Capture from camera 0
-cap = cv2.VideoCapture(0)
-cv2.startWindowThread()
+    output = maze_boi_multi(img, key) if args.multi else maze_boi(img, key, session)
+    count += 1
 
-while True:
-    _, img = cap.read()
+    if sink is not None:
+        sink.write(output)
+    if not args.headless:
+        cv2.imshow("input", output)
+    if count == 1:
+        first_frame = perf_counter()
+        print(f'first frame after {(first_frame-started)*1000:.0f} ms (imports {(imported-started)*1000:.0f} ms, '
+              f'opening the source {(first-imported)*1000:.0f} ms, reading and playing it {(first_frame-first)*1000:.0f} ms)')
 
-    key = cv2.waitKey(10)
-    if key == 27:
-        break
+seconds = perf_counter()-first
+print(f'{count} frames in {seconds:.2f}s ({count/seconds if seconds else 0:.1f} fps)')
+if session is not None and session.governor is not None:
+    stats = session.governor.stats()
+    print(f"quality level {stats['level']}, frames at each level: {stats['frames_at']}")
+if session is not None:
+    stats = session.preprocessor.stats()
+    print(f"buffers allocated: {stats['allocations']} ({stats['allocated_bytes']/1e6:.1f} MB), "
+          f"kept: {stats['buffers']} ({stats['bytes']/1e6:.1f} MB)")
 
-    output = maze_boi(img, key)
+if args.memory:
+    print(f"{'stage':<12}{'ms p50':>8}{'MB p50':>8}{'MB p95':>8}{'retained MB':>13}{'count':>7}")
+    stats = timers.stats()
+    for name, stage in stats.items():
+        if 'alloc_p50' in stage:
+            print(f"{name:<12}{stage['p50']:8.1f}{stage['alloc_p50']/1e6:8.2f}{stage['alloc_p95']/1e6:8.2f}"
+                  f"{stage['retained']/1e6:13.2f}{stage['count']:7d}")
+    print('live:', stats['mazes'])
 
-    cv2.imshow("input", output)
+source.release()
+if sink is not None:
+    sink.release()
+if session is not None and session.recorder is not None:
+    session.recorder.close()
+if session is not None and session.parse_worker is not None:
+    session.parse_worker.close()
 
-cv2.destroyAllWindows()
-cv2.waitKey(1)
-cv2.waitKey(1)
-cv2.waitKey(1)
-cv2.waitKey(1)
-cv2.VideoCapture(0).release()
-cv2.waitKey(1)
+if not args.headless:
+    cv2.destroyAllWindows()
+    cv2.waitKey(1)
+    cv2.waitKey(1)
+    cv2.waitKey(1)
+    cv2.waitKey(1)
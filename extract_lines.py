@@ -2,15 +2,18 @@ import numpy as np
 import cv2
 
 from build_the_maze import Line
+from preprocessing import blur, buffer_for
 
 
-def find_maze(img):
-    '''Finds the biggest object in the image and returns its 4 corners (to crop it)'''
+def find_maze(img, blurred=None, pool=None):
+    '''Finds the biggest object in the image and returns its 4 corners (to crop it)
+       blurred is blur(img), if we already have it. pool is a BufferPool for the edges'''
 
     # Preprocessing:
-    edges = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    edges = cv2.GaussianBlur(edges, (11, 11), 0)
-    edges = cv2.adaptiveThreshold(edges, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 19, 2)
+    if blurred is None:
+        blurred = blur(img)
+    edges = buffer_for(pool, 'maze_edges', blurred.shape)
+    cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 19, 2, dst=edges)
 
     # cv2.imshow('adad', edges)
 
@@ -44,7 +47,7 @@ def find_maze(img):
             if cv2.contourArea(cnt) > 5000:
                 rect = cv2.minAreaRect(cnt)
                 box = cv2.boxPoints(rect)
-                box = np.int0(box)
+                box = np.intp(box)
                 # Returns the 4 corners of an object with 4+ corners and area of >10k
                 return edges, corners
 
@@ -53,111 +56,157 @@ def find_maze(img):
     return edges, None
 
 
-def find_items(maze_image):
+def find_mazes(img, blurred=None, max_mazes=8, pool=None):
+    '''Like find_maze, but returns the 4 corners of every big object with 4+ corners
+       that isn't inside another one (biggest first, up to max_mazes)'''
+    if blurred is None:
+        blurred = blur(img)
+    edges = buffer_for(pool, 'maze_edges', blurred.shape)
+    cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 19, 2, dst=edges)
+
+    contours, _ = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+
+    found = []
+    mazes = []
+    for cnt in sorted(contours, key=cv2.contourArea, reverse=True):
+        if cv2.contourArea(cnt) <= 5000 or len(mazes) >= max_mazes:
+            break
+
+        epsilon = 0.025*cv2.arcLength(cnt, True)
+        cnt = cv2.approxPolyDP(cnt, epsilon, True)
+
+        if len(cnt) < 4 or cv2.contourArea(cnt) <= 5000:
+            continue
+
+        # The inside of a maze (or the inner edge of its paper) is not another maze
+        x, y = cnt[:, 0].mean(axis=0)
+        if any(cv2.pointPolygonTest(other, (float(x), float(y)), False) >= 0 for other in found):
+            continue
+
+        topleft =       min(cnt, key=lambda x: x[0,0]+x[0,1])
+        bottomright =   max(cnt, key=lambda x: x[0,0]+x[0,1])
+        topright =      max(cnt, key=lambda x: x[0,0]-x[0,1])
+        bottomleft =    min(cnt, key=lambda x: x[0,0]-x[0,1])
+
+        found.append(cnt)
+        mazes.append((topleft, topright, bottomleft, bottomright))
+
+    return edges, mazes
+
+
+def find_items(maze_image, blurred=None, method='contours', pool=None):
+    '''Finds the slimes ('smol') and dogs ('big') drawn in the maze.
+       method is 'contours' or 'components' (labelled connected components, see component_items).
+       pool is a BufferPool for the edges and the mask.
+       Returns a list of (np.array([[x, y]]), kind) and a mask of the items'''
     # Preprocessing to find the contour of the shapes
     h, w = maze_image.shape[0], maze_image.shape[1]
     dim = (h+w)//2
-    b_and_w = cv2.cvtColor(maze_image, cv2.COLOR_BGR2GRAY)
-    edges = cv2.GaussianBlur(b_and_w, (11, 11), 0)
-    edges = cv2.adaptiveThreshold(edges, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 9, 2)
+    if blurred is None:
+        blurred = blur(maze_image)
+    edges = buffer_for(pool, 'item_edges', blurred.shape)
+    cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 9, 2, dst=edges)
 
     cv2.rectangle(edges,(0, 0),(w-1,h-1),(255,255,255),16)
+    if method == 'components':
+        return component_items(edges, dim, pool)
+
     contours, _ = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
 
     # cv2.imshow('d', edges)
 
     items = []
 
-    if contours:
-        item_mask = np.zeros(edges.shape, np.uint8)
-        conts = sorted(contours, key=lambda x: cv2.contourArea(x), reverse=False)
+    item_mask = buffer_for(pool, 'item_mask', edges.shape)
+    item_mask.fill(0)
+    # Smallest first, every area measured once
+    areas = [cv2.contourArea(cnt) for cnt in contours]
+    for i in sorted(range(len(contours)), key=areas.__getitem__):
+        area, cnt = areas[i], contours[i]
 
-        for cnt in conts:
+        if area > 0.35*dim:
+            break
+
+        elif area > 0.05*dim:
+            d = np.mean(cnt, axis=0)
+            d[0][0], d[0][1] = int(round(d[0][0])), int(round(d[0][1]))
+
+            # TODO adjust the size here?
+            items.append((d, 'smol' if area < 0.1*dim else 'big'))
+            cv2.drawContours(item_mask, [cnt], -1, (255,255,255), -1)
 
-            if cv2.contourArea(cnt) > 0.35*dim:
-                return items, item_mask
+    return items, item_mask
 
-            elif cv2.contourArea(cnt) > 0.05*dim:
-                d = np.mean(cnt, axis=0)
-                d[0][0], d[0][1] = int(round(d[0][0])), int(round(d[0][1]))
 
-                # TODO adjust the size here?
-                if cv2.contourArea(cnt) < 0.1*dim:
-                    items.append((d, 'smol'))
-                    cv2.drawContours(item_mask, [cnt], -1, (255,255,255), -1)
-                else:
-                    items.append((d, 'big'))
-                    cv2.drawContours(item_mask, [cnt], -1, (255,255,255), -1)
+def component_items(edges, dim, pool=None):
+    '''find_items from the connected components of the dark pixels of edges:
+       one labelling gives every area, centroid and the item mask'''
+    # (edges isn't needed after this)
+    count, labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+        cv2.bitwise_not(edges, dst=edges), 8, cv2.CV_32S, cv2.CCL_GRANA)
+
+    # The contours find_items uses go around the blob through the pixels next to it,
+    # so its contour area is about the pixel area plus 3/4 of the bounding box's width+height.
+    # That way the same thresholds work for both
+    areas = stats[:, cv2.CC_STAT_AREA] + 0.75*(stats[:, cv2.CC_STAT_WIDTH] + stats[:, cv2.CC_STAT_HEIGHT])
+    areas[0] = np.inf   # Background (the white paper)
+    found = np.flatnonzero((areas > 0.05*dim) & (areas <= 0.35*dim))
+    # Smallest first, like the contours
+    found = found[np.argsort(areas[found], kind='stable')]
+
+    items = [(np.array([[round(x), round(y)]], dtype=float), 'smol' if area < 0.1*dim else 'big')
+             for (x, y), area in zip(centroids[found], areas[found])]
+
+    # Items are small, so the mask is only filled in inside their bounding boxes
+    item_mask = buffer_for(pool, 'item_mask', edges.shape)
+    item_mask.fill(0)
+    for label in found:
+        x, y, w, h = stats[label, :4]
+        item_mask[y:y+h, x:x+w][labels[y:y+h, x:x+w] == label] = 255
 
     return items, item_mask
 
 
-def find_lines(maze_image, item_mask=None):
+def find_lines(maze_image, item_mask=None, method='hough', blurred=None, pool=None):
+    '''Finds the walls of the maze. Returns lists of vertical and horizontal Lines (or None, None)
+       method='hough' uses HoughLinesP, method='projection' uses column/row occupancy (faster)
+       blurred is blur(maze_image), if we already have it. pool is a BufferPool for the edges'''
     w, h = maze_image.shape[1], maze_image.shape[0]
-    edges = cv2.cvtColor(maze_image, cv2.COLOR_BGR2GRAY)
-    edges = cv2.GaussianBlur(edges, (11, 11), 0)
+    if blurred is None:
+        blurred = blur(maze_image)
     # Make the 15 bigger if we're not getting some lines
-    edges = cv2.adaptiveThreshold(edges, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 7, 2)
+    edges = buffer_for(pool, 'line_edges', blurred.shape)
+    cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 7, 2, dst=edges)
     if item_mask is not None:
-        edges[item_mask > 0] = [0]
+        # The mask is 0 or 255: clears the edges wherever it's set
+        cv2.subtract(edges, item_mask, dst=edges)
 
     cv2.rectangle(edges,(0, 0),(w-1,h-1),(0,0,0),15)
 
+    if method == 'projection':
+        # Transposing makes horizontal lines vertical, like the flipping below
+        maze_vlines = projection_lines(edges, 'v')
+        maze_hlines = projection_lines(cv2.transpose(edges), 'h')
+        if maze_vlines is None or maze_hlines is None:
+            return None, None
+        return maze_vlines, maze_hlines
+
     # Getting vertical lines
     minLineLength = h/40
     maxLineGap = h/60
     vlines = cv2.HoughLinesP(edges, h, np.pi, threshold=0, minLineLength=minLineLength, maxLineGap=maxLineGap)
 
     # Flipping image and getting horizontal lines
-    flipped_edges = cv2.rotate(edges, cv2.ROTATE_90_COUNTERCLOCKWISE)
-    flipped_edges = cv2.flip(flipped_edges, 0)
+    rotated = buffer_for(pool, 'line_rotated', (w, h))
+    flipped_edges = buffer_for(pool, 'line_flipped', (w, h))
+    cv2.rotate(edges, cv2.ROTATE_90_COUNTERCLOCKWISE, dst=rotated)
+    cv2.flip(rotated, 0, dst=flipped_edges)
     minLineLength = flipped_edges.shape[0]/40
     maxLineGap = flipped_edges.shape[0]/60
     hlines = cv2.HoughLinesP(flipped_edges, w, np.pi, threshold=0, minLineLength=minLineLength, maxLineGap=maxLineGap)
 
-    # 2 is fine. Even 1 is fine but 2 just in case
-    line_thickness = 2
-
-    def group_lines(lines, direction):
-        if lines is None:
-            return None
-        else:
-            lines = sorted(lines, key=lambda k: k[0][0])
-            # Turn all vertical lines with similar X into one
-            # Turn all horizontal lines with similar Y into one
-            maze_lines = []
-            prevx = lines[0][0][0]
-            exes = []
-            if direction == 'v':
-                array = np.zeros((h), dtype=np.bool)
-            else:
-                array = np.zeros((flipped_edges.shape[0]), dtype=np.bool)
-
-            for line in lines:
-                x, y1, x2, y2 = line[0]
-                if x-prevx < line_thickness:
-                    array[y2:y1] = True
-                    exes.append(x)
-                else:
-                    maze_lines.append(Line(array, int(round(np.mean(exes))), direction))
-                    # Reset line
-                    if direction == 'v':
-                        array = np.zeros((h), dtype=np.bool)
-                    else:
-                        array = np.zeros((flipped_edges.shape[0]), dtype=np.bool)
-                    exes = []
-                    # Add to it
-                    array[y2:y1] = True
-                    exes.append(x)
-                prevx = x
-            else:
-                # When we are done, remember to append the last line
-                maze_lines.append(Line(array, int(round(np.mean(exes))), direction))
-
-        return maze_lines
-
-    maze_vlines = group_lines(vlines, 'v')
-    maze_hlines = group_lines(hlines, 'h')
+    maze_vlines = group_lines(vlines, 'v', h)
+    maze_hlines = group_lines(hlines, 'h', flipped_edges.shape[0])
 
     # cv2.imshow('ededed', maze_image)
 
@@ -165,3 +214,65 @@ def find_lines(maze_image, item_mask=None):
         return None, None
     else:
         return maze_vlines, maze_hlines
+
+
+def group_lines(lines, direction, length, line_thickness=2):
+    '''Turns the HoughLinesP segments of find_lines into Lines:
+       all vertical segments with similar X become one line (horizontal ones come flipped).
+       Segments whose X is less than line_thickness apart are the same line.
+       2 is fine. Even 1 is fine but 2 just in case'''
+    if lines is None:
+        return None
+
+    lines = lines.reshape(-1, 4)
+    lines = lines[np.argsort(lines[:, 0], kind='stable')]
+    xs, y1s, y2s = lines[:, 0], lines[:, 1], lines[:, 3]
+
+    # Which line each segment belongs to: a new one starts after every gap
+    group = np.zeros(len(xs), dtype=np.intp)
+    group[1:] = np.diff(xs) >= line_thickness
+    group = np.cumsum(group)
+    n = group[-1]+1
+
+    # Segments cover [y2, y1). Mark +1 where each starts and -1 where it ends,
+    # then a running sum along each row is > 0 wherever some segment covers it
+    y1s = np.clip(y1s, 0, length)
+    y2s = np.clip(y2s, 0, length)
+    valid = y1s > y2s
+    coverage = np.zeros((n, length+1), dtype=np.int32)
+    np.add.at(coverage, (group[valid], y2s[valid]), 1)
+    np.add.at(coverage, (group[valid], y1s[valid]), -1)
+    arrays = np.cumsum(coverage[:, :-1], axis=1) > 0
+
+    positions = np.bincount(group, weights=xs) / np.bincount(group)
+
+    return [Line(arrays[i], int(round(positions[i])), direction) for i in range(n)]
+
+
+def projection_lines(edges, direction, line_thickness=2):
+    '''Finds vertical lines in edges without Hough: the maze is axis aligned after cropping,
+       so a wall is a column with a long enough run of white pixels.
+       Uses the same length and gap limits as the HoughLinesP call in find_lines.'''
+    h = edges.shape[0]
+    min_length = max(1, int(h/40))
+    max_gap = max(1, int(h/60))
+
+    # Bridge small gaps along each column, then keep only runs that are long enough
+    runs = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, np.ones((max_gap+1, 1), np.uint8))
+    runs = cv2.morphologyEx(runs, cv2.MORPH_OPEN, np.ones((min_length, 1), np.uint8))
+
+    # How many wall pixels each column has
+    profile = np.count_nonzero(runs, axis=0)
+    columns = np.flatnonzero(profile)
+    if columns.size == 0:
+        return None
+
+    # Neighbouring columns are the same line
+    splits = np.flatnonzero(np.diff(columns) >= line_thickness) + 1
+    maze_lines = []
+    for group in np.split(columns, splits):
+        position = int(round(np.average(group, weights=profile[group])))
+        array = np.any(runs[:, group], axis=1)
+        maze_lines.append(Line(array, position, direction))
+
+    return maze_lines
@@ -0,0 +1,156 @@
+'''Where frames come from (camera, video file, folder of images) and where they go (video file).
+
+    source = VideoSource('recording.mp4')
+    for img in source.frames(paced=False):
+        ...
+
+paced=True hands out frames at the source's frame rate, paced=False as fast as they can be read.
+'''
+import os
+import sys
+from time import perf_counter, sleep
+
+import cv2
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+class FrameSource:
+    'Base class, subclasses implement read() (returns the next frame or None when done)'
+    fps = 30.0
+
+    def read(self):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+    def frames(self, paced=False, limit=None):
+        'Yields frames until the source runs out (or limit frames were given)'
+        interval = 1/self.fps if self.fps else 0
+        next_time = perf_counter()
+        count = 0
+        try:
+            while limit is None or count < limit:
+                img = self.read()
+                if img is None:
+                    break
+                if paced:
+                    wait = next_time - perf_counter()
+                    if wait > 0:
+                        sleep(wait)
+                    next_time = max(next_time + interval, perf_counter() - interval)
+                count += 1
+                yield img
+        finally:
+            self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class CameraSource(FrameSource):
+    'Live camera, already paced by the camera itself'
+    def __init__(self, index=0):
+        self.capture = cv2.VideoCapture(index)
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+
+    def read(self):
+        ok, img = self.capture.read()
+        return img if ok else None
+
+    def frames(self, paced=False, limit=None):
+        # Frames can't come faster than the camera gives them, no need to pace them
+        return super().frames(paced=False, limit=limit)
+
+    def release(self):
+        self.capture.release()
+
+
+class VideoSource(FrameSource):
+    def __init__(self, path, loop=False):
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        self.path = path
+        self.loop = loop
+        self.capture = cv2.VideoCapture(path)
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+
+    def read(self):
+        ok, img = self.capture.read()
+        if not ok and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, img = self.capture.read()
+        return img if ok else None
+
+    def release(self):
+        self.capture.release()
+
+
+class ImageDirSource(FrameSource):
+    'Every image in a folder, in name order'
+    def __init__(self, directory, fps=30.0, loop=False):
+        self.paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                            if name.lower().endswith(IMAGE_EXTENSIONS))
+        if not self.paths:
+            raise FileNotFoundError(f'No images in {directory}')
+        self.fps = fps
+        self.loop = loop
+        self.index = 0
+
+    def read(self):
+        'The next image that can be read (unreadable ones are skipped with a warning), None when done'
+        for _ in range(len(self.paths)):
+            if self.index >= len(self.paths):
+                if not self.loop:
+                    return None
+                self.index = 0
+            path = self.paths[self.index]
+            self.index += 1
+            img = cv2.imread(path)
+            if img is not None:
+                return img
+            print(f'Skipping {path}, it could not be read', file=sys.stderr)
+        # A whole pass over the folder without one readable image
+        return None
+
+
+class VideoSink:
+    'Writes frames to a video file, the size is taken from the first frame'
+    def __init__(self, path, fps=30.0, fourcc='mp4v'):
+        self.path = path
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.writer = None
+
+    def write(self, img):
+        if self.writer is None:
+            h, w = img.shape[0], img.shape[1]
+            self.writer = cv2.VideoWriter(self.path, self.fourcc, self.fps, (w, h))
+        self.writer.write(img)
+
+    def release(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+def open_source(video=None, images=None, camera=0, loop=False, fps=30.0):
+    'Picks a source: a video file, a folder of images or (by default) a camera'
+    if video is not None:
+        return VideoSource(video, loop=loop)
+    if images is not None:
+        return ImageDirSource(images, fps=fps, loop=loop)
+    return CameraSource(camera)
@@ -1,21 +1,43 @@
-from helpers import Singleton, overlay_transparent, resize_transparent_sprite
+from helpers import overlay_transparent, resize_transparent_sprite, ChangeGate
 from maze_solver import astar
-from load_images import load_player, load_slime, load_doggy, load_heart
+from load_images import shared_assets
+from build_the_maze import shared_maze_cache, Maze, Case
+from preprocessing import Preprocessor
 
+import gc
 import numpy as np
-from math import log
-
-from time import perf_counter
-
-
-@Singleton
-class Master:
-    def __init__(self):
-        # Loading sprites
-        self.player_sprite = load_player()
-        self.slime_sprite = load_slime()
-        self.dog_sprite = load_doggy()
-        self.heart_sprite = load_heart()
+from math import log, sqrt
+from zlib import crc32
+
+from timers import timers
+
+
+# Most bytes of resized sprite frames a Session keeps (they're float64, a big player is ~0.5 MB a frame)
+RESIZED_SPRITE_BYTES = 8_000_000
+
+
+class Session:
+    '''One game, and what maze_boi keeps between the frames of its stream.
+       Sessions don't share anything that changes, so each one can run on its own thread.
+       assets (sprites) and maze_cache (built mazes) are read-only and shared by default'''
+    def __init__(self, assets=None, maze_cache=None):
+        # The shared sprites are only loaded when the first game starts (see the assets property)
+        self._assets = assets
+        self.maze_cache = maze_cache if maze_cache is not None else shared_maze_cache()
+
+        # Vision: gray/blurred buffers of the frame and the crop,
+        # and the gate that skips parsing the maze again while the crop stays the same
+        self.preprocessor = Preprocessor()
+        self.parse_gate = ChangeGate()
+        # Workspace the maze is warped into (see helpers.Workspace), or None to crop it at its size on screen
+        self.workspace = None
+        # Governor that lowers the quality when frames take too long (see governor.py), or None
+        self.governor = None
+        # ParseWorker that parses the crops on another thread (see image_parsing.py), or None to parse them here
+        self.parse_worker = None
+        # Corners of the last find_maze, and frames since it ran (the governor can skip it while playing)
+        self.last_corners = None
+        self.skipped_detections = 0
 
         self.key = 32           # Spacebar
         self.playing = False
@@ -25,53 +47,152 @@ class Master:
         self.original_height = None
         self.original_width = None
 
-        self.original_vlines = []
-        self.original_hlines = []
         self.original_xgrid = []
         self.original_ygrid = []
 
+        # Mazes this session built or copied from maze_cache, with their own cases
         self.built_mazes = dict()
+        # (maze string, maze_array, case_array, entrances) of the last maze built, to patch when it's drawn on
+        self.last_built = None
 
         self.units = []
         self.ignored_entrances = []
         self.cheering_dogs = []
 
+        # Ticks stepped since the session was made
+        self.ticks = 0
+        # Recorder that logs every frame (see recording.py), or None
+        self.recorder = None
+        # Sprite frames already resized, by (sprite, frame, height) (see resized_sprite)
+        self.resized_sprites = dict()
+        self.resized_sprite_bytes = 0
+
+    @property
+    def assets(self):
+        if self._assets is None:
+            self._assets = shared_assets()
+        return self._assets
+
+    @property
+    def player_sprite(self):
+        return self.assets.player
+
+    @property
+    def slime_sprite(self):
+        return self.assets.slime
+
+    @property
+    def dog_sprite(self):
+        return self.assets.dog
+
+    @property
+    def heart_sprite(self):
+        return self.assets.heart
+
+    def resized_sprite(self, sprite, frame, height):
+        '''Frame frame of sprite (one of the assets) resized to height pixels.
+           Units are the same size every frame, so each one is only resized the first time'''
+        key = (id(sprite), frame, height)
+        resized = self.resized_sprites.get(key)
+        if resized is None:
+            # (packed sprites are uint8, they're drawn as floats like the ones loaded from the sheets)
+            resized = resize_transparent_sprite(np.asarray(sprite[:,:,:,frame], dtype=np.float64), height=height)
+            # Without a workspace the height changes with the crop, so old sizes are dropped now and then
+            if self.resized_sprite_bytes + resized.nbytes > RESIZED_SPRITE_BYTES:
+                self.resized_sprites.clear()
+                self.resized_sprite_bytes = 0
+            self.resized_sprites[key] = resized
+            self.resized_sprite_bytes += resized.nbytes
+        return resized
+
     def get_min_dimension(self):
         'Gets the minimum height/width of the smallest square in the grid, for resizing sprites'
-        min_dimension = np.inf
-        for vline, nextvline in zip(self.maze.vlines, self.maze.vlines[1:]):
-            min_dimension = min(min_dimension, nextvline.position - vline.position)
-        for hline, nexthline in zip(self.maze.hlines, self.maze.hlines[1:]):
-            min_dimension = min(min_dimension, nexthline.position - hline.position)
-        return min_dimension
-
-    def step(self, img_cropped_maze):
-        t = perf_counter()
+        return self.maze.geometry.min_cell
 
+    def step(self, img_cropped_maze=None):
+        'Moves every unit one tick and draws them on img_cropped_maze (skips drawing if None)'
         # We calculate the smallest case there is and make the units a size that fits it
         min_dimension = self.get_min_dimension()
+        self.ticks += 1
 
-        # Do actions for each unit
-        if self.player.action not in ['cheering', 'dead']:
-            self.player.step(min_dimension)
-            for npc in self.enemies + self.dogs:
-                npc.step(min_dimension)
-        # Dogs can still walk out even after the player finished the map
-        for dog in self.cheering_dogs:
-            dog.step(min_dimension)
+        # Do actions for each unit (includes the time spent pathfinding)
+        with timers.time('ai'):
+            if self.player.action not in ['cheering', 'dead']:
+                self.player.step(min_dimension)
+                for npc in self.enemies + self.dogs:
+                    npc.step(min_dimension)
+            # Dogs can still walk out even after the player finished the map
+            for dog in self.cheering_dogs:
+                dog.step(min_dimension)
 
-        # print(f'passed {perf_counter()-t}')
-        t = perf_counter()
+        if img_cropped_maze is None:
+            return
 
         # Draw each unit (player has priority so draw him last)
-        for enemy in self.enemies:
-            enemy.draw(img_cropped_maze, sprite_height=min_dimension)
-        for dog in self.dogs + self.cheering_dogs:
-            dog.draw(img_cropped_maze, sprite_height=int(round(min_dimension*1.25)))
-        self.player.draw(img_cropped_maze, sprite_height=int(round(min_dimension*1.8)))
-
-        # print(f'drawing {perf_counter()-t}')
-        t = perf_counter()
+        with timers.time('units'):
+            for enemy in self.enemies:
+                enemy.draw(img_cropped_maze, sprite_height=min_dimension)
+            for dog in self.dogs + self.cheering_dogs:
+                dog.draw(img_cropped_maze, sprite_height=int(round(min_dimension*1.25)))
+            self.player.draw(img_cropped_maze, sprite_height=int(round(min_dimension*1.8)))
+
+    def advance(self, corners, maze, valid, key, shape, img_cropped_maze=None):
+        '''What a frame does to the game, once the vision stages are done.
+           corners are where the maze was found (None if it wasn't), shape the (h, w) of its crop.
+           maze and valid are the parsed maze (None when we weren't looking for one) and whether it's valid.
+           Steps the game (drawing on img_cropped_maze, if given) when playing.
+           Returns False if there is nothing to paste on the frame'''
+        # If we need to find a maze (when paused, we look for the maze we were on before)
+        if self.playing is False or self.pause is True:
+            if corners is not None:
+                if maze is None or valid is not True:
+                    return False
+
+                if self.pause is True:
+                    # When it finds it, it just returns to it
+                    if np.array_equal(maze.maze_array, self.maze.maze_array):
+                        self.pause = False
+
+                if self.playing is False:
+                    self.ready = True
+                    h, w = maze.crop_shape()
+                    # Ready to play, listen to key press
+                    if key == self.key:
+                        self.dump_maze(maze, h, w)
+                        self.start()
+                        # Parse afresh if we go back to looking for a maze
+                        self.parse_gate.reset()
+                        if self.parse_worker is not None:
+                            self.parse_worker.reset()
+                        key = -1    # So we don't trigger another keypress
+
+        # Playing the game
+        if self.playing is True and self.pause is False:
+            if corners is not None:
+                with timers.time('step'):
+                    self.adjust_lines(shape[0], shape[1])
+                    self.step(img_cropped_maze)
+            else:
+                # If no object was found we have to look for the same maze again
+                # When we got it, it will unpause.
+                self.pause = True
+
+        # Exit button (unloads the maze)
+        if self.playing is True:
+            if key == self.key:
+                self.stop()
+
+        return True
+
+    def checksum(self):
+        'CRC of the state of the game and its units, to tell whether two runs went the same way'
+        state = [self.playing, self.pause, self.ready, self.ticks]
+        if self.playing:
+            for unit in [self.player] + self.enemies + self.dogs + self.cheering_dogs:
+                moving_to = unit.moving_to.position if unit.moving_to is not None else None
+                state.append((unit.array_y, unit.array_x, unit.relative_y, unit.relative_x, moving_to,
+                              len(unit.path or []), unit.action, unit.direction, getattr(unit, 'hp', None)))
+        return crc32(repr(state).encode())
 
     def start(self):
         'Only do this one, time, when starting a new maze for the first time'
@@ -115,28 +236,16 @@ class Master:
 
     def dump_maze(self, maze, h, w):
         self.maze = maze
+        # Sizes (and speeds) start from the crop it was parsed from, even if it was played before
+        maze.geometry.rescale(1, 1)
         self.original_height = h
         self.original_width = w
-        self.original_vlines = [line.position for line in maze.vlines]
-        self.original_hlines = [line.position for line in maze.hlines]
         self.original_xgrid = maze.xgrid
         self.original_ygrid = maze.ygrid
 
     def adjust_lines(self, h, w):
         'Since lines can change position when the maze is moved, we have to keep adjusting them'
-        h_proportion = h/self.original_height
-        w_proportion = w/self.original_width
-
-        for i, line in enumerate(self.original_vlines):
-            self.maze.vlines[i].position = int(round(line*w_proportion))
-        for i, line in enumerate(self.original_hlines):
-            self.maze.hlines[i].position = int(round(line*h_proportion))
-
-        new_xgrid = [int(round(line*w_proportion)) for line in self.original_xgrid]
-        new_ygrid = [int(round(line*h_proportion)) for line in self.original_ygrid]
-
-        self.maze.xgrid = new_xgrid
-        self.maze.ygrid = new_ygrid
+        self.maze.geometry.rescale(h/self.original_height, w/self.original_width)
 
 
 class Unit:
@@ -158,12 +267,15 @@ class Unit:
         self.direction = 3
 
     def real_position(self):
-        first_y, first_x = self.maze.real_position(self.array_y, self.array_x)
+        # Units are always inside the maze, so we can look their positions up directly
+        geometry = self.maze.geometry
+        ys, xs = geometry.ys_list, geometry.xs_list
+        first_y, first_x = ys[self.array_y], xs[self.array_x]
 
         if self.moving_to is None:
             y, x = first_y, first_x
         else:
-            second_y, second_x = self.maze.real_position(self.moving_to.position[0], self.moving_to.position[1])
+            second_y, second_x = ys[self.moving_to.position[0]], xs[self.moving_to.position[1]]
 
             if self.moving_to.position[0] == self.array_y:
                 # we move horizontally
@@ -184,10 +296,7 @@ class Unit:
     def real_distance(self, other):
         other_y, other_x = other.real_position()
         y, x = self.real_position()
-        a = np.array([other_y, other_x])
-        b = np.array([y, x])
-        dist = np.linalg.norm(a-b)
-        return dist
+        return sqrt((other_y-y)**2 + (other_x-x)**2)
 
 
 class Mover(Unit):
@@ -222,7 +331,8 @@ class Mover(Unit):
         'Makes self.path into a list of steps from the object to the goal'
         if start is None:
             start = self.maze.case_array[self.array_y, self.array_x]
-        path, distance = astar(self.maze, start, goal)
+        with timers.time('pathfinding'):
+            path, distance = astar(self.maze, start, goal)
         return path, distance
 
     def set_path(self, path_tuple):
@@ -389,8 +499,7 @@ class Player(Mover):
 
         center_y, center_x = self.real_position()
         # resize sprite_to_draw
-        sprite_to_draw = sprite[:,:,:,current_frame]
-        sprite_to_draw = resize_transparent_sprite(sprite_to_draw, height=sprite_height)
+        sprite_to_draw = self.game.resized_sprite(sprite, current_frame, sprite_height)
 
         # x, y are exactly the center and the writing is done on topleft corner
         # What if he's too big for the image? well he shouldn't be
@@ -407,10 +516,7 @@ class Player(Mover):
         sprite = self.game.heart_sprite[0]
         threshold = self.max_hp//(self.hearts_shown*2)
 
-        fullheart, halfheart, emptyheart = sprite[:,:,:,0], sprite[:,:,:,1], sprite[:,:,:,2],
-        fullheart = resize_transparent_sprite(fullheart, height=sprite_height//3)
-        halfheart = resize_transparent_sprite(halfheart, height=sprite_height//3)
-        emptyheart = resize_transparent_sprite(emptyheart, height=sprite_height//3)
+        fullheart, halfheart, emptyheart = [self.game.resized_sprite(sprite, i, sprite_height//3) for i in range(3)]
         left_heart_x = x-(fullheart.shape[1]*self.hearts_shown//2)
         if self.direction == 1 and self.action == 'fighting':
             draw_y = int(round(bottom_y+fullheart.shape[0]/1.5))
@@ -577,8 +683,7 @@ class Enemy(Mover):
 
         y, x = self.real_position()
         # resize sprite_to_draw
-        sprite_to_draw = sprite[:,:,:,current_frame]
-        sprite_to_draw = resize_transparent_sprite(sprite_to_draw, height=sprite_height)
+        sprite_to_draw = self.game.resized_sprite(sprite, current_frame, sprite_height)
 
         # x, y are exactly the center and the writing is done on topleft corner
         # What if he's too big for the image? well he shouldn't be
@@ -654,8 +759,7 @@ class Item(Mover):
 
         current_frame = int(self.current_frame)
         # resize sprite_to_draw
-        sprite_to_draw = sprite[:,:,:,current_frame]
-        sprite_to_draw = resize_transparent_sprite(sprite_to_draw, height=sprite_height)
+        sprite_to_draw = self.game.resized_sprite(sprite, current_frame, sprite_height)
 
         # first_y, first_x = self.maze.real_position(self.array_y, self.array_x)
         # y, x = first_y, first_x
@@ -665,3 +769,29 @@ class Item(Mover):
         y = int(round(center_y-sprite_to_draw.shape[0]/2))
         x = int(round(center_x-sprite_to_draw.shape[1]/2))
         overlay_transparent(image, sprite_to_draw, y, x)
+
+
+def live_objects():
+    '''How many Sessions, Mazes and Cases are alive (found by walking every object the garbage collector
+       knows, so it's slow), and how many mazes and cases the sessions and the shared cache keep.
+       Cases no maze or cache keeps are from mazes that were thrown away (and not collected yet)'''
+    counts = {'Session': 0, 'Maze': 0, 'Case': 0, 'session_mazes': 0, 'session_cases': 0}
+    for obj in gc.get_objects():
+        kind = type(obj)
+        if kind is Case:
+            counts['Case'] += 1
+        elif kind is Maze:
+            counts['Maze'] += 1
+        elif kind is Session:
+            counts['Session'] += 1
+            counts['session_mazes'] += len(obj.built_mazes)
+            counts['session_cases'] += sum(case_array.size for case_array, _, _ in obj.built_mazes.values())
+    cache = shared_maze_cache()
+    with cache.lock:
+        built = list(cache.built_mazes.values())
+    counts['cache_mazes'] = len(built)
+    counts['cache_cases'] = sum(case_array.size for case_array, _, _ in built)
+    return counts
+
+
+timers.gauge('mazes', live_objects)
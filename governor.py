@@ -0,0 +1,113 @@
+'''Keeps maze_boi near a target frame time by trading quality for speed.
+
+    session.governor = Governor(target_ms=1000/20)    # aim for 20 fps
+    ...
+    session.governor.level, session.governor.stats()
+
+Every level is cheaper than the one before it (measured on a 1080p frame while playing):
+    0  everything at full quality
+    1  the game is pasted with a hard edge instead of the feathered blend   (blend ~110 ms -> ~3 ms)
+    2  while playing, the maze is found on a half size frame                (detect ~20 ms -> ~8 ms)
+    3  while playing, the maze is only looked for every 2nd frame
+    4  while playing, every 3rd frame (the frames in between reuse its corners)
+The maze is always found at full size, every frame, while looking for one to play,
+since parsing it needs corners that are exactly right.
+'''
+
+
+class Quality:
+    '''What maze_boi does at one level.
+       detect_scale: size of the frame find_maze looks at while playing (1 is full size)
+       detect_every: while playing, find_maze runs every detect_every frames
+       soft_blend: feathered blend of the game onto the frame (or a hard edged paste)'''
+    def __init__(self, detect_scale=1.0, detect_every=1, soft_blend=True):
+        self.detect_scale = detect_scale
+        self.detect_every = detect_every
+        self.soft_blend = soft_blend
+
+    def __repr__(self):
+        return (f'Quality(detect_scale={self.detect_scale}, detect_every={self.detect_every}, '
+                f'soft_blend={self.soft_blend})')
+
+
+FULL_QUALITY = Quality()
+
+LEVELS = [
+    FULL_QUALITY,
+    Quality(soft_blend=False),
+    Quality(detect_scale=0.5, soft_blend=False),
+    Quality(detect_scale=0.5, detect_every=2, soft_blend=False),
+    Quality(detect_scale=0.5, detect_every=3, soft_blend=False),
+]
+
+
+class Governor:
+    '''Watches how long frames take and moves between LEVELS to stay under target_ms.
+       Goes one level down (cheaper) when the average frame time is over target_ms,
+       and one back up when it has been under target_ms*headroom for a while.
+       If going up makes it go over again soon after, it waits twice as long before the next try'''
+    def __init__(self, target_ms, levels=LEVELS, headroom=0.6, smoothing=0.2, cooldown=10, up_after=30):
+        self.target_ms = target_ms
+        self.levels = levels
+        self.headroom = headroom
+        # Weight of the newest frame in the average
+        self.smoothing = smoothing
+        # Frames to wait after a change before the next one (so the average catches up)
+        self.cooldown = cooldown
+        # Frames the average has to stay under budget before going back up
+        self.up_after = up_after
+        self.first_up_after = up_after
+
+        self.level = 0
+        self.average = None
+        self.frames = 0
+        self.wait = 0
+        self.under = 0
+        self.raised_at = None
+        self.changes = 0
+        self.frames_at = [0]*len(levels)
+
+    @property
+    def quality(self):
+        return self.levels[self.level]
+
+    def update(self, ms):
+        'Adds the time the last frame took. Returns the level for the next frame'
+        self.average = ms if self.average is None else self.average + self.smoothing*(ms-self.average)
+        self.frames += 1
+        self.frames_at[self.level] += 1
+
+        if self.wait > 0:
+            self.wait -= 1
+            return self.level
+
+        if self.average > self.target_ms:
+            self.under = 0
+            if self.level < len(self.levels)-1:
+                # Going up didn't last, try less often
+                if self.raised_at is not None and self.frames-self.raised_at < self.up_after:
+                    self.up_after *= 2
+                self.change(self.level+1)
+        elif self.average < self.target_ms*self.headroom:
+            self.under += 1
+            if self.level > 0 and self.under >= self.up_after:
+                self.raised_at = self.frames
+                self.change(self.level-1)
+        else:
+            self.under = 0
+            # It held for a good while, so the next step up can be tried sooner
+            if self.raised_at is not None and self.frames-self.raised_at > 4*self.up_after:
+                self.up_after = self.first_up_after
+                self.raised_at = None
+        return self.level
+
+    def change(self, level):
+        self.level = level
+        self.wait = self.cooldown
+        self.under = 0
+        self.changes += 1
+
+    def stats(self):
+        'For monitoring: current level and quality, average frame time and frames spent at each level'
+        return {'level': self.level, 'quality': repr(self.quality), 'average_ms': self.average,
+                'target_ms': self.target_ms, 'changes': self.changes, 'frames_at': list(self.frames_at)}
@@ -1,8 +1,16 @@
 import numpy as np
 import cv2
 
+from preprocessing import buffer_for
 
-def crop_from_points(img, corners, make_square=False):
+
+ERODE_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+
+
+def crop_from_points(img, corners, make_square=False, workspace=None, pool=None):
+    '''Warps the part of img inside corners into a straight rectangle, the size of the maze in img
+       or the shape workspace (a Workspace) gives for it. The crop is written in pool's buffer if given.
+       Returns the crop and the transformation (matrix and original_shape) to paste it back'''
 
     cnt = np.array([corners[0], corners[1], corners[2], corners[3]])
 
@@ -16,23 +24,27 @@ def crop_from_points(img, corners, make_square=False):
 
         rect = (center, size, theta)
         box = cv2.boxPoints(rect)
-        box = np.int0(box)
+        box = np.intp(box)
 
         height = int(rect[1][0])
         width = int(rect[1][1])
     else:
         rect = (center, size, theta)
         box = cv2.boxPoints(rect)
-        box = np.int0(box)
+        box = np.intp(box)
 
         height = int(rect[1][1])
         width = int(rect[1][0])
 
+    if workspace is not None:
+        height, width = workspace.shape(height, width)
+
     src_pts = np.float32([corners[0],corners[1],corners[2],corners[3]])
     dst_pts = np.float32([[0,0],[width,0],[0,height],[width,height]])
 
     M = cv2.getPerspectiveTransform(src_pts, dst_pts)
-    warped = cv2.warpPerspective(img, M, (width, height))
+    warped = buffer_for(pool, 'crop_warp', (height, width) + img.shape[2:], img.dtype)
+    cv2.warpPerspective(img, M, (width, height), dst=warped)
 
     transformation_data = {
         'matrix': M,
@@ -42,31 +54,63 @@ def crop_from_points(img, corners, make_square=False):
     return warped, transformation_data
 
 
-def perspective_transform(img, transformation_matrix, original_shape=None, full_image_shape=(480,640)):
+def perspective_transform(img, transformation_matrix, original_shape=None, full_image_shape=(480,640), pool=None):
 
     h, w = full_image_shape[0], full_image_shape[1]
 
-    warped = cv2.warpPerspective(img, transformation_matrix, (w, h))
+    warped = buffer_for(pool, 'warp_back', (h, w) + img.shape[2:], img.dtype)
+    cv2.warpPerspective(img, transformation_matrix, (w, h), dst=warped)
 
     return warped
 
 
-def blend_non_transparent(sprite, background_img):
-    gray_overlay = cv2.cvtColor(background_img, cv2.COLOR_BGR2GRAY)
-    overlay_mask = cv2.threshold(gray_overlay, 1, 255, cv2.THRESH_BINARY)[1]
+def overlay_mask(background_img, pool=None):
+    'Mask of where background_img is not black, shrunk by a pixel (written in the gray buffer of the blend)'
+    gray_overlay = buffer_for(pool, 'blend_gray', background_img.shape[:2])
+    mask = buffer_for(pool, 'blend_mask', background_img.shape[:2])
+    cv2.cvtColor(background_img, cv2.COLOR_BGR2GRAY, dst=gray_overlay)
+    cv2.threshold(gray_overlay, 1, 255, cv2.THRESH_BINARY, dst=mask)
+    cv2.erode(mask, ERODE_KERNEL, dst=gray_overlay)
+    return gray_overlay
 
-    overlay_mask = cv2.erode(overlay_mask, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
-    overlay_mask = cv2.blur(overlay_mask, (3, 3))
 
-    background_mask = 255 - overlay_mask
+def blend_non_transparent(sprite, background_img, pool=None):
+    '''background_img pasted over sprite wherever it isn't black, with a feathered edge.
+       The result and the float temporaries are pool's buffers, if given'''
+    h, w = background_img.shape[:2]
+    eroded = overlay_mask(background_img, pool)
+    mask = buffer_for(pool, 'blend_mask', (h, w))
+    cv2.blur(eroded, (3, 3), dst=mask)
 
-    overlay_mask = cv2.cvtColor(overlay_mask, cv2.COLOR_GRAY2BGR)
-    background_mask = cv2.cvtColor(background_mask, cv2.COLOR_GRAY2BGR)
+    # Weights (0 to 1) of each image, one channel broadcast over the three
+    overlay_weight = buffer_for(pool, 'blend_overlay_weight', (h, w, 1), np.float64)
+    background_weight = buffer_for(pool, 'blend_background_weight', (h, w, 1), np.float64)
+    np.multiply(mask[..., None], 1 / 255.0, out=overlay_weight)
+    np.subtract(255, mask, out=eroded)
+    np.multiply(eroded[..., None], 1 / 255.0, out=background_weight)
 
-    sprite_part = (sprite * (1 / 255.0)) * (background_mask * (1 / 255.0))
-    overlay_part = (background_img * (1 / 255.0)) * (overlay_mask * (1 / 255.0))
+    sprite_part = buffer_for(pool, 'blend_sprite', sprite.shape, np.float64)
+    overlay_part = buffer_for(pool, 'blend_overlay', background_img.shape, np.float64)
+    np.multiply(sprite, 1 / 255.0, out=sprite_part)
+    np.multiply(sprite_part, background_weight, out=sprite_part)
+    np.multiply(background_img, 1 / 255.0, out=overlay_part)
+    np.multiply(overlay_part, overlay_weight, out=overlay_part)
 
-    return np.uint8(cv2.addWeighted(sprite_part, 255.0, overlay_part, 255.0, 0.0))
+    cv2.addWeighted(sprite_part, 255.0, overlay_part, 255.0, 0.0, dst=sprite_part)
+    blended = buffer_for(pool, 'blend', sprite.shape)
+    np.copyto(blended, sprite_part, casting='unsafe')
+    return blended
+
+
+def paste_non_transparent(sprite, background_img, pool=None):
+    '''Cheaper blend_non_transparent: background_img is copied over sprite wherever it isn't black,
+       with a hard edge instead of a feathered one'''
+    mask = overlay_mask(background_img, pool)
+
+    pasted = buffer_for(pool, 'blend', sprite.shape)
+    np.copyto(pasted, sprite)
+    cv2.copyTo(background_img, mask, pasted)
+    return pasted
 
 
 def overlay_transparent(background, overlay, y, x):
@@ -146,40 +190,76 @@ def resize_transparent_sprite(image, width=None, height=None, inter=cv2.INTER_AR
     return new_image
 
 
-class Singleton:
-    """
-    A non-thread-safe helper class to ease implementing singletons.
-    This should be used as a decorator -- not a metaclass -- to the
-    class that should be a singleton.
-
-    The decorated class can define one `__init__` function that
-    takes only the `self` argument. Also, the decorated class cannot be
-    inherited from. Other than that, there are no restrictions that apply
-    to the decorated class.
-
-    To get the singleton instance, use the `instance` method. Trying
-    to use `__call__` will result in a `TypeError` being raised.
-
-    """
-
-    def __init__(self, decorated):
-        self._decorated = decorated
-
-    def instance(self):
-        """
-        Returns the singleton instance. Upon its first call, it creates a
-        new instance of the decorated class and calls its `__init__` method.
-        On all subsequent calls, the already created instance is returned.
-
-        """
-        try:
-            return self._instance
-        except AttributeError:
-            self._instance = self._decorated()
-            return self._instance
-
-    def __call__(self):
-        raise TypeError('Singletons must be accessed through `instance()`.')
-
-    def __instancecheck__(self, inst):
-        return isinstance(inst, self._decorated)
+class Workspace:
+    '''Fixed size to warp the cropped maze into, so it has the same shape every frame
+       however big the maze is on screen. Its longer side is long_side pixels (or the maze's own
+       size if that is smaller, upscaling only blurs the lines) and the other one follows the
+       maze's aspect ratio, both rounded to a multiple of step.
+       The shape only changes when the aspect ratio or the maze's size change by more than tolerance'''
+
+    def __init__(self, long_side=480, step=16, tolerance=0.05):
+        self.long_side = long_side
+        self.step = step
+        self.tolerance = tolerance
+        self.aspect = None
+        self.size = None
+        self.current = None
+
+    def shape(self, height, width):
+        '(h, w) to warp a maze of height x width pixels into'
+        aspect = height/max(1, width)
+        size = min(self.long_side, max(height, width))
+        if (self.aspect is None or abs(aspect-self.aspect) > self.aspect*self.tolerance
+                or abs(size-self.size) > self.size*self.tolerance):
+            self.aspect = aspect
+            self.size = size
+            long = max(self.step, int(round(size/self.step))*self.step)
+            short = max(self.step, int(round(long*min(aspect, 1/aspect)/self.step))*self.step)
+            self.current = (long, short) if height >= width else (short, long)
+        return self.current
+
+
+class ChangeGate:
+    '''Tells whether an image changed since the last time it was let through,
+       by comparing small (size x size) downsampled copies of its middle part.
+       The cropped maze jitters a few pixels every frame, so this only catches big changes
+       (like a different maze). Small ones (a wall drawn or erased) are caught because
+       every max_skips-th image gets through anyway, and so does any image whose
+       shape changed by more than shape_tolerance.
+       Whatever was computed from the last image let through can be kept in .result'''
+
+    def __init__(self, threshold=8.0, size=16, border=0.05, max_skips=10, shape_tolerance=0.05):
+        # Mean absolute difference (in gray levels) that counts as a change
+        self.threshold = threshold
+        self.size = size
+        self.border = border
+        self.max_skips = max_skips
+        self.shape_tolerance = shape_tolerance
+        self.reset()
+
+    def reset(self):
+        self.last = None
+        self.shape = None
+        self.skipped = 0
+        self.result = None
+
+    def signature(self, gray):
+        h, w = gray.shape[0], gray.shape[1]
+        bh, bw = int(h*self.border), int(w*self.border)
+        return cv2.resize(gray[bh:h-bh, bw:w-bw], (self.size, self.size), interpolation=cv2.INTER_AREA)
+
+    def resized(self, shape):
+        return (abs(shape[0]-self.shape[0]) > self.shape[0]*self.shape_tolerance
+                or abs(shape[1]-self.shape[1]) > self.shape[1]*self.shape_tolerance)
+
+    def changed(self, gray):
+        small = self.signature(gray)
+        if (self.last is None or self.skipped >= self.max_skips or self.resized(gray.shape)
+                or cv2.mean(cv2.absdiff(small, self.last))[0] > self.threshold):
+            self.last = small
+            self.shape = gray.shape
+            self.skipped = 0
+            return True
+
+        self.skipped += 1
+        return False
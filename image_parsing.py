@@ -1,104 +1,169 @@
+import os
+from contextlib import nullcontext
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Condition, Thread
+
 import numpy as np
 import cv2
 
-from helpers import crop_from_points, perspective_transform, blend_non_transparent
-from extract_lines import find_lines, find_maze, find_items
+from helpers import crop_from_points, perspective_transform, blend_non_transparent, paste_non_transparent
+from extract_lines import find_lines, find_maze, find_mazes, find_items
 from build_the_maze import Maze
-from game import Master
+from game import Session
+from preprocessing import Preprocessor, BufferPool
+from timers import timers
+from governor import FULL_QUALITY
+from recording import fingerprint
+
+
+_default_session = None
+_default_session_lock = Lock()
 
-from datetime import datetime
+
+def default_session():
+    'The session maze_boi uses when it is not given one, made on the first frame'
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = Session()
+        return _default_session
 
 
 # MAIN
-def maze_boi(img_original, key):
-    first = datetime.now()
-    game = Master.instance()
+def maze_boi(img_original, key, session=None):
+    '''Finds the maze in the camera image and plays it.
+       session holds the game and everything kept between frames, one per stream of frames
+       (the default session if None). Returns the image with the game pasted on it,
+       which is one of the session's buffers (overwritten on its next frame)'''
+    if session is None:
+        session = default_session()
 
-    # Tries to find the part of the image with the maze
-    img_test, corners = find_maze(img_original)
+    # 't' toggles the timers and writing them on the frame
+    if key == ord('t'):
+        timers.enabled = not timers.enabled
+        timers.overlay = timers.enabled
 
-    # If we need to find a maze (when paused, we look for the maze we were on before)
-    # Grabbing maze image and creating maze
-    if game.playing is False or game.pause is True:
-        # If we got an object (maybe maze?)
-        if corners is not None:
-            # We crop out the maze and get the info needed to paste it back (matrix)
-            img_cropped_maze, transformation = crop_from_points(img_original, corners)
-            # cv2.imshow('asdasdasdasd', img_cropped_maze)
-            # with img_cropped_maze get the red bits and extract them (mask)
-            transformation_matrix = transformation['matrix']
-            original_shape = transformation['original_shape']
+    first = perf_counter()
+    with timers.time('frame'):
+        quality = session.governor.quality if session.governor is not None else FULL_QUALITY
 
-            # We inverse the matrix so we can do the opposite transformation later
-            transformation_matrix = np.linalg.pinv(transformation_matrix)
+        # Tries to find the part of the image with the maze
+        with timers.time('detect'):
+            corners = detect_maze(img_original, session, quality)
 
-            items, item_mask = find_items(img_cropped_maze)
+        img_maze_final = process_maze(img_original, corners, key, session)
 
-            vlines, hlines = find_lines(img_cropped_maze, item_mask)
+        # Pasting cropped maze into full image
+        if img_maze_final is not None:
+            with timers.time('blend'):
+                if quality.soft_blend:
+                    img_final = blend_non_transparent(img_original, img_maze_final, session.preprocessor)
+                else:
+                    img_final = paste_non_transparent(img_original, img_maze_final, session.preprocessor)
 
-            if vlines and hlines:
-                maze = Maze(vlines, hlines)
-                maze.get_walkable_grid()
+        else:
+            # If we found no maze, return same image
+            img_final = img_original
 
-                # Visuals
-                # maze.draw_grid(img_cropped_maze)
-                # maze.draw_lines(img_cropped_maze)
-                maze.draw_maze(img_cropped_maze)
+    if session.governor is not None:
+        session.governor.update((perf_counter()-first)*1000)
 
-                # Turn the maze into an array we can work with
-                maze.build_maze(items, key=key)
-                # img_cropped_maze[item_mask > 0] = (180, 255, 0)
-                maze.draw_items(img_cropped_maze)
+    if timers.overlay:
+        timers.draw(img_final)
 
-                if maze.is_valid() is not True:
-                    return img_original
-                else:
+    return img_final
+
+
+def detect_maze(img_original, session, quality=FULL_QUALITY):
+    '''find_maze on the frame. While playing, quality can make it look at a smaller frame
+       or only every few frames (reusing the last corners in between)'''
+    playing = session.playing is True and session.pause is False
+    if not playing:
+        quality = FULL_QUALITY
 
-                    if game.pause is True:
-                        # When it finds it, it just returns to it
-                        if np.array2string(maze.maze_array) == np.array2string(game.maze.maze_array):
-                            game.pause = False
-
-                    if game.playing is False:
-                        game.ready = True
-                        h, w = img_cropped_maze.shape[0], img_cropped_maze.shape[1]
-                        # Ready to play, listen to key press
-                        if key == game.key:
-                            game.dump_maze(maze, h, w)
-                            game.start()
-                            key = -1    # So we don't trigger another keypress
-
-            else:
-                return img_original
-
-    # Playing the game
-    if game.playing is True and game.pause is False:
+    if (quality.detect_every > 1 and session.last_corners is not None
+            and session.skipped_detections < quality.detect_every-1):
+        session.skipped_detections += 1
+        return session.last_corners
+    session.skipped_detections = 0
+
+    pool = session.preprocessor
+    scale = quality.detect_scale
+    if scale < 1:
+        h, w = img_original.shape[:2]
+        small = pool.buffer('small_frame', (round(h*scale), round(w*scale)) + img_original.shape[2:])
+        cv2.resize(img_original, (small.shape[1], small.shape[0]), dst=small, interpolation=cv2.INTER_AREA)
+        blurred = pool.blur(small, 'small_frame')
+        img_test, corners = find_maze(small, blurred, pool)
         if corners is not None:
-            img_cropped_maze, transformation = crop_from_points(img_original, corners)
+            corners = tuple(np.rint(corner/scale).astype(corner.dtype) for corner in corners)
+    else:
+        blurred = pool.blur(img_original, 'frame')
+        img_test, corners = find_maze(img_original, blurred, pool)
+
+    session.last_corners = corners
+    return corners
+
+
+def process_maze(img_original, corners, key, game):
+    '''Looks for a maze to play, or plays it, in the part of img_original inside corners
+       (None if the maze wasn't found in this frame). game is the maze's Session.
+       Returns the cropped maze (with everything drawn on it) warped back to the full image,
+       or None if there is nothing to paste'''
+
+    if corners is not None:
+        # We crop out the maze and get the info needed to paste it back (matrix)
+        with timers.time('crop'):
+            img_cropped_maze, transformation = crop_from_points(img_original, corners, workspace=game.workspace,
+                                                                pool=game.preprocessor)
             transformation_matrix = transformation['matrix']
             original_shape = transformation['original_shape']
+
+            # We inverse the matrix so we can do the opposite transformation later
             transformation_matrix = np.linalg.pinv(transformation_matrix)
-            # first = datetime.now()
-            maze = game.maze
-            h, w = img_cropped_maze.shape[0], img_cropped_maze.shape[1]
-            game.adjust_lines(h, w)
-            # maze.draw_grid(img_cropped_maze)
-            game.step(img_cropped_maze)
-            # print(f'time-taken: {datetime.now()-first}')
-            # maze.draw_items(img_cropped_maze)
-
-        elif corners is None:
-            # If no object was found we have to look for the same maze again
-            # When we got it, it will unpause.
-            game.pause = True
-
-    # Exit button (unloads the maze)
-    if game.playing is True:
-        if key == game.key:
-            game.stop()
-            key = -1    # So we don't trigger another keypress
-
-    # Pasting cropped maze into full image
+        shape = img_cropped_maze.shape[:2]
+    else:
+        img_cropped_maze, shape = None, None
+
+    # If we need to find a maze (when paused, we look for the maze we were on before)
+    maze, valid = None, False
+    from_worker = False
+    if (game.playing is False or game.pause is True) and corners is not None:
+        # Only parse the maze again if it looks different from the last one we parsed
+        with timers.time('preprocess'):
+            blurred = game.preprocessor.blur(img_cropped_maze, 'crop')
+        # ('q' prints the parsed maze, so it has to be parsed)
+        changed = key == ord('q') or game.parse_gate.changed(blurred)
+        if game.parse_worker is not None:
+            # Parsed on the worker's thread, this frame gets whatever it parsed last (below)
+            if changed:
+                game.parse_worker.submit(img_cropped_maze, blurred, key)
+            from_worker = True
+        else:
+            if changed:
+                game.parse_gate.result = parse_maze(img_cropped_maze, blurred, key, game)
+            maze, valid = game.parse_gate.result
+        # The maze (and its lines) may be from a crop of a slightly different size than this one
+
+    # Starting, pausing, stepping (units are drawn on the crop) and stopping the game
+    ticks = game.ticks
+    with (game.parse_worker.lock if game.parse_worker is not None else nullcontext()):
+        if from_worker:
+            maze, valid, _ = game.parse_worker.result
+        paste = game.advance(corners, maze, valid, key, shape, img_cropped_maze)
+    if game.recorder is not None:
+        game.recorder.frame(game, corners, key, shape, maze, valid)
+    if not paste:
+        return None
+
+    # Visuals of the maze we're looking at, drawn once per parsed maze (and crop size) and pasted in one go
+    if maze is not None and game.ticks == ticks:
+        with timers.time('overlay'):
+            layer, mask = maze.overlay(img_cropped_maze.shape)
+            cv2.copyTo(layer, mask, img_cropped_maze)
+
+    # Warping the cropped maze back into the shape of the full image
     if corners is not None:
         # We paste the cropped maze which is now solved into the camera image
         # TODO HIDE?: Test texts:
@@ -110,18 +175,268 @@ def maze_boi(img_original, key):
         #     write_text(img_original, 'Press space to begin!')
         #     game.ready = False
         # cv2.imshow('cropped', img_cropped_maze)
-        img_maze_final = perspective_transform(img_cropped_maze, transformation_matrix,
-                                               original_shape, img_original.shape)
-        img_final = blend_non_transparent(img_original, img_maze_final)
+        with timers.time('warp_back'):
+            return perspective_transform(img_cropped_maze, transformation_matrix,
+                                         original_shape, img_original.shape, game.preprocessor)
+
+    return None
+
+
+# Several mazes at once
+class MazeSlot:
+    'A maze of a MazeGroup: its session and where it was last seen'
+    def __init__(self, session):
+        self.session = session
+        self.center = None
+        self.missing = 0    # Frames since we last saw it
+
+
+class MazeGroup:
+    '''What maze_boi_multi keeps between the frames of one stream: a slot per maze,
+       and the threads that process them'''
+    # Mazes that stay unseen (and aren't being played) for this many frames are forgotten
+    forget_after = 30
+
+    def __init__(self, workers=None, assets=None, maze_cache=None):
+        self.preprocessor = Preprocessor()
+        self.slots = []
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.assets = assets
+        self.maze_cache = maze_cache
+
+    def new_slot(self):
+        slot = MazeSlot(Session(self.assets, self.maze_cache))
+        self.slots.append(slot)
+        return slot
+
+    def close(self):
+        self.pool.shutdown()
+
 
+_default_group = None
+
+
+def default_group():
+    global _default_group
+    with _default_session_lock:
+        if _default_group is None:
+            _default_group = MazeGroup()
+        return _default_group
+
+
+def maze_boi_multi(img_original, key, group=None):
+    '''Like maze_boi, but plays every maze in the frame, each one with its own session.
+       The mazes are processed at the same time on the threads of group (the default group if None)'''
+    if group is None:
+        group = default_group()
+
+    if key == ord('t'):
+        timers.enabled = not timers.enabled
+        timers.overlay = timers.enabled
+
+    with timers.time('detect'):
+        blurred = group.preprocessor.blur(img_original, 'frame')
+        img_test, all_corners = find_mazes(img_original, blurred, pool=group.preprocessor)
+
+    jobs = match_slots(group, all_corners)
+    results = group.pool.map(lambda job: process_maze(img_original, job[1], key, job[0].session), jobs)
+    warped = [img for img in results if img is not None]
+
+    if warped:
+        with timers.time('blend'):
+            # The mazes don't overlap, so their black backgrounds can be merged into one image
+            img_maze_final = warped[0]
+            for img in warped[1:]:
+                cv2.max(img_maze_final, img, dst=img_maze_final)
+            img_final = blend_non_transparent(img_original, img_maze_final, group.preprocessor)
     else:
-        # If we found no maze, return same image
         img_final = img_original
 
-    # print(f'time-taken: {datetime.now()-first}')
+    if timers.overlay:
+        timers.draw(img_final)
+
     return img_final
 
 
+def match_slots(group, all_corners):
+    '''Gives each maze found in this frame the slot of the maze that was closest to it last frame
+       (or a new slot). Returns a list of (slot, corners), where slots that weren't found get None'''
+    unmatched = list(group.slots)
+    jobs = []
+    for corners in all_corners:
+        points = np.array(corners).reshape(4, 2)
+        center = points.mean(axis=0)
+        # It's the same maze if it moved less than a quarter of its diagonal
+        max_distance = np.linalg.norm(points[0]-points[3])/4
+
+        closest = min(unmatched, key=lambda slot: np.linalg.norm(slot.center-center), default=None)
+        if closest is not None and np.linalg.norm(closest.center-center) < max_distance:
+            slot = closest
+            unmatched.remove(slot)
+        else:
+            slot = group.new_slot()
+        slot.center = center
+        slot.missing = 0
+        jobs.append((slot, corners))
+
+    for slot in unmatched:
+        slot.missing += 1
+        # So its game gets paused if it was being played
+        jobs.append((slot, None))
+
+    group.slots[:] = [slot for slot in group.slots
+                      if slot.missing <= group.forget_after or slot.session.playing]
+    return jobs
+
+
+def parse_maze(img_cropped_maze, blurred, key=None, session=None, pool=None):
+    '''Finds the items and lines of the cropped maze and builds the Maze.
+       blurred is the blurred crop (from the preprocessor), session the Session whose built mazes to reuse.
+       pool is the BufferPool for the edges (session's by default).
+       Returns the Maze (None if there were no lines) and whether it's valid'''
+    items, vlines, hlines = find_maze_parts(img_cropped_maze, blurred, session, pool)
+    return build_parsed_maze(items, vlines, hlines, key, session)
+
+
+def find_maze_parts(img_cropped_maze, blurred, session=None, pool=None):
+    'The first half of parse_maze: the items, vlines and hlines of the cropped maze'
+    if pool is None and session is not None:
+        pool = session.preprocessor
+    with timers.time('items'):
+        items, item_mask = find_items(img_cropped_maze, blurred, pool=pool)
+
+    with timers.time('lines'):
+        vlines, hlines = find_lines(img_cropped_maze, item_mask, blurred=blurred, pool=pool)
+    return items, vlines, hlines
+
+
+def build_parsed_maze(items, vlines, hlines, key=None, session=None):
+    '''The second half of parse_maze: builds the Maze from what find_maze_parts found
+       (it uses the session's mazes). Returns the Maze (None if there were no lines) and whether it's valid'''
+    if not vlines or not hlines:
+        return None, False
+
+    with timers.time('build'):
+        maze = Maze(vlines, hlines)
+        maze.get_walkable_grid()
+
+        # Turn the maze into an array we can work with
+        maze.build_maze(items, key=key, session=session)
+
+    with timers.time('validate'):
+        valid = maze.is_valid()
+
+    return maze, valid
+
+
+class ParseWorker:
+    '''Parses the crops of a Session on a thread of its own, so maze_boi doesn't wait for it
+       while looking for a maze. Set it as session.parse_worker (and close() it when done).
+       Only the newest crop waits to be parsed: submitting another one replaces it.
+       result is (maze, valid, fingerprint) of the last crop parsed, replaced in one go
+       ((None, False, 0) until there is one). The frames keep using it until the next one is done.
+       If parsing a crop raises, the result goes back to (None, False, 0) and the exception
+       is raised (once) by the next read of result or call to wait.
+       Building the maze (and publishing it as result) uses the session's mazes, and the frames
+       read result and step the game with it, so both hold lock while they do'''
+    def __init__(self, session):
+        self.session = session
+        self.lock = Lock()
+        # Its own buffers, the ones of the session get overwritten by the next frame
+        self.pool = BufferPool()
+        self.condition = Condition()
+        self.job = None
+        self.generation = 0
+        self._result = (None, False, 0)
+        self.error = None
+        self.parsed = 0
+        self.dropped = 0
+        self.busy = False
+        self.closed = False
+        self.thread = Thread(target=self.run, name='parse worker', daemon=True)
+        self.thread.start()
+
+    @property
+    def result(self):
+        with self.condition:
+            self.raise_error()
+            return self._result
+
+    def raise_error(self):
+        'Raises what the last crop parsed raised, if it did and nobody got it yet (holding condition)'
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, img_cropped_maze, blurred, key=-1):
+        'Parses a copy of the crop (and of its blurred gray) when the thread gets to it'
+        with self.condition:
+            if self.job is not None:
+                self.dropped += 1
+            self.job = (img_cropped_maze.copy(), blurred.copy(), key, self.generation)
+            self.condition.notify()
+
+    def reset(self):
+        'Forgets the result and anything still being parsed (the game started, the next maze is another one)'
+        with self.condition:
+            self.generation += 1
+            self.job = None
+            self._result = (None, False, 0)
+            self.error = None
+
+    def wait(self, timeout=None):
+        'Waits until every crop submitted has been parsed. Returns False on timeout'
+        with self.condition:
+            done = self.condition.wait_for(lambda: self.job is None and not self.busy, timeout)
+            self.raise_error()
+            return done
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.job is not None or self.closed)
+                if self.closed:
+                    return
+                img_cropped_maze, blurred, key, generation = self.job
+                self.job = None
+                self.busy = True
+
+            try:
+                items, vlines, hlines = find_maze_parts(img_cropped_maze, blurred, self.session, self.pool)
+
+                # Published before letting go of the lock, so a frame never steps the game with
+                # a result older than the session's mazes
+                with self.lock:
+                    maze, valid = build_parsed_maze(items, vlines, hlines, key, self.session)
+                    self.publish((maze, valid, fingerprint(maze) if maze is not None else 0), None, generation)
+            except Exception as error:
+                # Kept for the frames, as parse_maze would have raised in their thread
+                self.publish((None, False, 0), error, generation)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def publish(self, result, error, generation):
+        'Makes result (and error) what the frames get, unless the worker was reset while parsing'
+        with self.condition:
+            if generation == self.generation:
+                self._result = result
+                self.error = error
+                if error is None:
+                    self.parsed += 1
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        'For monitoring: crops parsed, and crops replaced by a newer one before they were parsed'
+        return {'parsed': self.parsed, 'dropped': self.dropped}
+
+
 def write_text(image, text):
     h, w = image.shape[0], image.shape[1]
     font = cv2.FONT_HERSHEY_DUPLEX
@@ -1,7 +1,33 @@
+'''The sprites of the game, sliced out of the sheets in images/ into arrays of (h, w, BGRA, frame).
+
+Slicing (and flipping) the sheets is done once, into a sprite pack the game memory-maps instead:
+
+    python load_images.py                  # writes images/sprites.pack from the sheets
+
+A pack is MAGIC, the length of its header, the header (json: where every array is,
+and the size and crc32 of every sheet it was made from) and then the arrays, as uint8.
+If the pack is missing or a sheet changed since it was made, the sheets are loaded instead.
+'''
+import argparse
+import json
+import os
+import struct
+from threading import Lock
+from time import perf_counter
+from zlib import crc32
+
 import numpy as np
 import cv2
 
 
+SPRITE_PACK = 'images/sprites.pack'
+SHEETS = ['images/32x36guy.png', 'images/16x20slime.png', 'images/32x32dog.png', 'images/16x16hearts.png']
+MAGIC = b'HAZYSPR1'
+HEADER = struct.Struct('<I')
+# Where the arrays start in the pack (and each one after the other) is a multiple of this
+ALIGN = 64
+
+
 def load_slime():
     slime = cv2.imread('images/16x20slime.png', cv2.IMREAD_UNCHANGED)
 
@@ -93,3 +119,104 @@ def load_heart():
             direction[:, :, :, i] = heart[j*16:j*16+16,i*16:i*16+16,:]
 
     return heart_sprite
+
+
+def load_sheets():
+    'Every sprite, sliced out of the sheets: {name: [array of each direction]}'
+    return {'player': load_player(), 'slime': load_slime(), 'dog': load_doggy(), 'heart': load_heart()}
+
+
+def sheet_stamps():
+    '{sheet: [size, crc32]} of the sheets, to tell whether a pack was made from them'
+    stamps = dict()
+    for path in SHEETS:
+        with open(path, 'rb') as f:
+            data = f.read()
+        stamps[path] = [len(data), crc32(data)]
+    return stamps
+
+
+def save_sprite_pack(path=SPRITE_PACK):
+    'Slices the sheets and writes every sprite into the pack at path'
+    sprites = load_sheets()
+    arrays = dict()
+    offset = 0
+    for name, directions in sprites.items():
+        arrays[name] = []
+        for direction in directions:
+            arrays[name].append({'shape': direction.shape, 'offset': offset})
+            offset += -(-direction.size//ALIGN)*ALIGN
+    header = json.dumps({'sheets': sheet_stamps(), 'arrays': arrays}).encode()
+    start = -(-(len(MAGIC)+HEADER.size+len(header))//ALIGN)*ALIGN
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC + HEADER.pack(len(header)) + header)
+        for name, directions in sprites.items():
+            for direction, where in zip(directions, arrays[name]):
+                f.seek(start+where['offset'])
+                # The sheets are 8 bit, so nothing is lost
+                f.write(np.ascontiguousarray(direction, dtype=np.uint8).tobytes())
+
+
+def load_sprite_pack(path=SPRITE_PACK):
+    '''Every sprite in the pack at path, as read-only views of the memory-mapped file
+       (only read from disk when drawn). None if there is no pack or a sheet changed since it was made'''
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        length, = HEADER.unpack(f.read(HEADER.size))
+        header = json.loads(f.read(length))
+    if header['sheets'] != sheet_stamps():
+        return None
+
+    start = -(-(len(MAGIC)+HEADER.size+length)//ALIGN)*ALIGN
+    data = np.memmap(path, dtype=np.uint8, mode='r', offset=start)
+    return {name: [data[where['offset']:where['offset']+int(np.prod(where['shape']))].reshape(where['shape'])
+                   for where in directions]
+            for name, directions in header['arrays'].items()}
+
+
+class Assets:
+    '''Every sprite the game draws, loaded once and shared by all the sessions.
+       They come from the sprite pack if it's up to date, or from the sheets.
+       The arrays are read-only, sessions only draw resized copies of them'''
+    def __init__(self, pack=SPRITE_PACK):
+        first = perf_counter()
+        sprites = load_sprite_pack(pack) if pack is not None else None
+        self.source = 'pack' if sprites is not None else 'sheets'
+        if sprites is None:
+            sprites = load_sheets()
+        self.player = sprites['player']
+        self.slime = sprites['slime']
+        self.dog = sprites['dog']
+        self.heart = sprites['heart']
+        for sprite in (self.player, self.slime, self.dog, self.heart):
+            for direction in sprite:
+                direction.setflags(write=False)
+        self.load_ms = (perf_counter()-first)*1000
+
+
+_assets = None
+_assets_lock = Lock()
+
+
+def shared_assets():
+    'The Assets of this process, loaded on the first call'
+    global _assets
+    with _assets_lock:
+        if _assets is None:
+            _assets = Assets()
+        return _assets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the sprite pack the game loads its sprites from')
+    parser.add_argument('--output', default=SPRITE_PACK)
+    args = parser.parse_args()
+
+    save_sprite_pack(args.output)
+    assets = Assets(args.output)
+    print(f'{args.output}: {os.path.getsize(args.output)/1000:.1f} kB, loads in {assets.load_ms:.2f} ms '
+          f'({Assets(None).load_ms:.2f} ms from the sheets)')
@@ -0,0 +1,122 @@
+'''Load generator for server.py: replays a recording from several clients at once
+and measures the frame rate and latency each one gets back.
+
+    python server.py &
+    python load_test.py --video recording.mp4 --clients 1 2 4 8 --seconds 10
+
+Without --video or --images it replays synthetic frames of a maze.
+'''
+import argparse
+import asyncio
+import json
+from time import perf_counter
+
+import numpy as np
+
+from frame_sources import open_source
+from server import FRAME, REPLY, encode, read_message, write_message
+
+
+def load_frames(video=None, images=None, limit=300):
+    'Encoded frames of the recording (or of a synthetic maze), read before the test starts'
+    if video is None and images is None:
+        from synthetic import random_maze, make_frame
+        rng = np.random.default_rng(0)
+        frame, _ = make_frame(random_maze(10, 10, 2, 2, rng=rng), (480, 640), rng=rng)
+        return [encode(frame, 90)]
+    source = open_source(video=video, images=images)
+    return [encode(img, 90) for img in source.frames(limit=limit)]
+
+
+async def client(frames, host, port, fps, seconds, start_at):
+    '''Sends frames (looping) at fps for seconds, pressing space on frame start_at.
+       Returns the latencies (s) of the processed frames and how many were dropped'''
+    reader, writer = await asyncio.open_connection(host, port)
+    sent = dict()
+    latencies = []
+    dropped = 0
+
+    async def sender():
+        interval = 1/fps
+        first = perf_counter()
+        frame_id = 0
+        while perf_counter()-first < seconds:
+            key = 32 if frame_id == start_at else -1
+            sent[frame_id] = perf_counter()
+            write_message(writer, FRAME, frame_id, key, payload=frames[frame_id % len(frames)])
+            await writer.drain()
+            frame_id += 1
+            await asyncio.sleep(max(0, first + frame_id*interval - perf_counter()))
+        # The server answers what it still has and hangs up
+        writer.write_eof()
+
+    sending = asyncio.create_task(sender())
+    try:
+        # Every frame gets a reply, processed or dropped
+        while True:
+            frame_id, ms, payload = await read_message(reader, REPLY)
+            sent_at = sent.pop(frame_id)
+            if payload:
+                latencies.append(perf_counter()-sent_at)
+            else:
+                dropped += 1
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        sending.cancel()
+        writer.close()
+    return latencies, dropped
+
+
+def run(frames, clients, host='127.0.0.1', port=8765, fps=30.0, seconds=10.0, start_at=3):
+    '''Runs clients clients at the same time.
+       Returns the processed frame rate (total and per client), latency percentiles in ms and drop rate'''
+    async def everyone():
+        return await asyncio.gather(*[client(frames, host, port, fps, seconds, start_at)
+                                      for _ in range(clients)])
+
+    first = perf_counter()
+    results = asyncio.run(everyone())
+    elapsed = perf_counter()-first
+
+    latencies = np.concatenate([np.array(latency) for latency, _ in results]) * 1000
+    processed = len(latencies)
+    dropped = sum(dropped for _, dropped in results)
+    result = {'clients': clients, 'processed': processed, 'dropped': dropped,
+              'drop_rate': dropped/max(1, processed+dropped),
+              'fps': processed/elapsed, 'fps_per_client': processed/elapsed/clients}
+    for p in (50, 95, 99):
+        result[f'p{p}'] = float(np.percentile(latencies, p)) if processed else None
+    return result
+
+
+def print_results(results):
+    print(f"{'clients':>7} {'fps':>7} {'fps/client':>10} {'p50':>8} {'p95':>8} {'p99':>8} {'dropped':>8}")
+    for r in results:
+        latency = ''.join(f'{r[p]:>8.1f}' if r[p] is not None else f"{'-':>8}" for p in ('p50', 'p95', 'p99'))
+        print(f"{r['clients']:>7} {r['fps']:>7.1f} {r['fps_per_client']:>10.1f} {latency} {r['drop_rate']*100:>7.1f}%")
+    print('(latency in ms, from sending a frame to getting it back)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test for server.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--video', help='recording to replay')
+    parser.add_argument('--images', help='folder of frames to replay')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 2, 4],
+                        help='numbers of concurrent clients to try, one after the other')
+    parser.add_argument('--fps', type=float, default=30.0, help='frames per second each client sends')
+    parser.add_argument('--seconds', type=float, default=10.0, help='how long each run lasts')
+    parser.add_argument('--start-at', type=int, default=3, help='frame on which clients press space')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    frames = load_frames(args.video, args.images)
+    results = [run(frames, clients, args.host, args.port, args.fps, args.seconds, args.start_at)
+               for clients in args.clients]
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,124 @@
+'''Random mazes of any size, for testing the maze compiler and the solver without images.
+
+    maze_array = generate_maze(100, 100, loops=0.1, entrances=4, smol=0.01, big=0.01, rng=0)
+    vlines, hlines, items = maze_lines(maze_array)      # what find_lines and find_items would give
+
+maze_array is like the one Maze.build_maze makes: 1 is wall, 0 is walkable, 9 is a slime and 7 is a dog.
+'''
+import numpy as np
+
+from build_the_maze import Line
+
+
+def perfect_maze(rows, cols, rng):
+    '''maze_array of a maze with exactly one way between any two cells (recursive backtracker),
+       closed all around'''
+    maze_array = np.ones((rows*2+1, cols*2+1), dtype=np.uint8)
+    maze_array[1::2, 1::2] = 0
+
+    visited = np.zeros((rows, cols), dtype=bool)
+    stack = [(rng.integers(rows), rng.integers(cols))]
+    visited[stack[0]] = True
+    while stack:
+        y, x = stack[-1]
+        nexts = [(y+dy, x+dx) for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1))
+                 if 0 <= y+dy < rows and 0 <= x+dx < cols and not visited[y+dy, x+dx]]
+        if not nexts:
+            stack.pop()
+            continue
+        ny, nx = nexts[rng.integers(len(nexts))]
+        # Knock down the wall between both cells
+        maze_array[y+ny+1, x+nx+1] = 0
+        visited[ny, nx] = True
+        stack.append((ny, nx))
+
+    return maze_array
+
+
+def add_loops(maze_array, loops, rng):
+    'Knocks down loops (0 to 1) of the walls left between cells, so there is more than one way around'
+    inner = maze_array[1:-1, 1:-1]
+    # Walls between two cells are where exactly one of the coordinates is odd (in maze_array)
+    ys, xs = np.nonzero(inner == 1)
+    between = (ys % 2) != (xs % 2)
+    ys, xs = ys[between], xs[between]
+    chosen = rng.choice(len(ys), size=int(round(loops*len(ys))), replace=False)
+    inner[ys[chosen], xs[chosen]] = 0
+
+
+def add_entrances(maze_array, entrances, rng):
+    '''Opens the first entrance on the top row, the second on the bottom row
+       and the rest anywhere on the border. Returns the sides that have entrances'''
+    rows, cols = maze_array.shape[0]//2, maze_array.shape[1]//2
+    maze_array[0, rng.integers(cols)*2+1] = 0
+    sides = {'top'}
+    if entrances > 1:
+        maze_array[-1, rng.integers(cols)*2+1] = 0
+        sides.add('bottom')
+
+    # The openings still closed on every side
+    border = [(0, x*2+1, 'top') for x in range(cols)] + [(-1, x*2+1, 'bottom') for x in range(cols)] + \
+             [(y*2+1, 0, 'left') for y in range(rows)] + [(y*2+1, -1, 'right') for y in range(rows)]
+    border = [(y, x, side) for y, x, side in border if maze_array[y, x] == 1]
+    extra = min(max(0, entrances-2), len(border))
+    if extra:
+        for i in rng.choice(len(border), size=extra, replace=False):
+            y, x, side = border[i]
+            maze_array[y, x] = 0
+            sides.add(side)
+    return sides
+
+
+def place_items(maze_array, smol, big, rng, sides=('top', 'bottom')):
+    '''Puts smol slimes and big dogs in random cells, except in the rows and columns
+       along the sides that have entrances (so nothing sits in a doorway)'''
+    rows, cols = maze_array.shape[0]//2, maze_array.shape[1]//2
+    ys = range(1 if 'top' in sides else 0, rows-1 if 'bottom' in sides else rows)
+    xs = range(1 if 'left' in sides else 0, cols-1 if 'right' in sides else cols)
+    cells = [(y, x) for y in ys for x in xs]
+    chosen = rng.choice(len(cells), size=min(smol+big, len(cells)), replace=False)
+    for i, index in enumerate(chosen):
+        y, x = cells[index]
+        maze_array[y*2+1, x*2+1] = 9 if i < smol else 7
+
+
+def generate_maze(rows, cols, loops=0.0, entrances=2, smol=0.0, big=0.0, rng=None):
+    '''maze_array of a random rows x cols maze.
+       loops is the fraction of inner walls knocked down after making a perfect maze (0 keeps it perfect),
+       entrances how many openings the border has (at least 1),
+       smol and big the fraction of cells with a slime and a dog'''
+    rng = np.random.default_rng(rng)
+    maze_array = perfect_maze(rows, cols, rng)
+    if loops > 0:
+        add_loops(maze_array, loops, rng)
+    sides = add_entrances(maze_array, entrances, rng)
+    place_items(maze_array, int(round(smol*rows*cols)), int(round(big*rows*cols)), rng, sides)
+    return maze_array
+
+
+def maze_lines(maze_array, cell=10, margin=None):
+    '''The lines and items find_lines and find_items would find in a crop of maze_array
+       drawn with cells of cell pixels and a margin around it.
+       Returns (vlines, hlines, items), ready for Maze(vlines, hlines) and build_maze(items)'''
+    margin = cell//2 if margin is None else margin
+    rows, cols = maze_array.shape[0]//2, maze_array.shape[1]//2
+    h, w = rows*cell + 2*margin, cols*cell + 2*margin
+
+    # A line is wall along every cell it has a wall next to
+    vwalls = maze_array[1::2, 0::2].T == 1
+    hwalls = maze_array[0::2, 1::2] == 1
+    vline_arrays = np.zeros((cols+1, h), dtype=bool)
+    hline_arrays = np.zeros((rows+1, w), dtype=bool)
+    vline_arrays[:, margin:margin+rows*cell] = np.repeat(vwalls, cell, axis=1)
+    hline_arrays[:, margin:margin+cols*cell] = np.repeat(hwalls, cell, axis=1)
+
+    vlines = [Line(array, margin+i*cell, 'v') for i, array in enumerate(vline_arrays)]
+    hlines = [Line(array, margin+i*cell, 'h') for i, array in enumerate(hline_arrays)]
+
+    # Items like find_items gives them: ([[x, y]], kind) at the middle of their cell
+    items = []
+    for y, x in zip(*np.nonzero(maze_array > 1)):
+        center = np.array([[margin + (x//2)*cell + cell//2, margin + (y//2)*cell + cell//2]], dtype=float)
+        items.append((center, 'smol' if maze_array[y, x] == 9 else 'big'))
+
+    return vlines, hlines, items
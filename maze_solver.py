@@ -1,7 +1,5 @@
 from queue import PriorityQueue
 
-import pickle
-
 
 def astar(maze_object, start, destination, clear=True):
     # Quote for test
@@ -39,7 +37,7 @@ def distance_to(one, other):
     return abs(one.position[1]-other.position[1])+abs(one.position[0]-other.position[0])
 
 
-# TESTING WITH PICKLED MAZE
+# TESTING WITH SAVED MAZE
 if __name__ == '__main__':
     # test results:
     # [(0, 19), (3, 19), (3, 23), (7, 23), (7, 19), (9, 19), (9, 17), (11, 17), (13, 17),
@@ -53,8 +51,8 @@ if __name__ == '__main__':
     # (23, 9), (27, 9), (27, 11), (25, 11), (25, 13), (31, 13), (31, 15), (27, 15), (27, 17),
     # (27, 21), (31, 21), (31, 17), (33, 17), (33, 13), (37, 13), (39, 13), (39, 15), (39, 21), (40, 21)]
 
-    with open('pickled_maze', 'rb') as f:
-        maze = pickle.load(f)
+    from build_the_maze import load_maze
+    maze = load_maze('maze.npz')
 
     # TEST ONLY
     # Get the entrance and the exit
@@ -75,5 +73,5 @@ if __name__ == '__main__':
     # print(maze.case_array)
     # print(start.position, destination.position)
 
-    path = astar(maze.case_array, start, destination)
+    path = astar(maze, start, destination)
     print(path)
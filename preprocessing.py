@@ -0,0 +1,67 @@
+'''Grayscale + blur that find_maze, find_items and find_lines all start with.
+
+maze_boi does it once per image (the frame and the cropped maze) with a Preprocessor,
+and hands the result to every stage. The stages still do it themselves if not given one.
+
+A Preprocessor is also the BufferPool the other stages of maze_boi take their arrays from
+(the crop, the warp back, the blend...), so once a maze is being played a frame allocates
+no new images at all. pool.allocations counts the ones it had to make.
+'''
+import numpy as np
+import cv2
+
+
+BLUR_SIZE = (11, 11)
+
+
+def blur(img):
+    'Grayscale and blurred copy of a BGR image'
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.GaussianBlur(gray, BLUR_SIZE, 0)
+
+
+class BufferPool:
+    '''Arrays kept between frames by name, for the stages to write into (dst= in OpenCV, out= in numpy)
+       instead of allocating new ones. A name's array is only allocated again when it's asked for
+       with another shape or dtype. Its contents are whatever was written in it last.
+       allocations and allocated_bytes count the arrays it made, to check they stop growing'''
+    def __init__(self):
+        self.buffers = dict()
+        self.allocations = 0
+        self.allocated_bytes = 0
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buffer
+            self.allocations += 1
+            self.allocated_bytes += buffer.nbytes
+        return buffer
+
+    def stats(self):
+        'For monitoring: arrays allocated so far, and how many and how big the ones kept now are'
+        return {'allocations': self.allocations, 'allocated_bytes': self.allocated_bytes,
+                'buffers': len(self.buffers), 'bytes': sum(b.nbytes for b in self.buffers.values())}
+
+
+def buffer_for(pool, name, shape, dtype=np.uint8):
+    'pool.buffer(name, shape, dtype), or a new array if there is no pool'
+    if pool is None:
+        return np.empty(shape, dtype=dtype)
+    return pool.buffer(name, shape, dtype)
+
+
+class Preprocessor(BufferPool):
+    '''Keeps the gray and blurred buffers of each named image ('frame', 'crop') between frames,
+       so they are only allocated again when the image changes size.
+       What it returns is overwritten the next time the same name is prepared.'''
+
+    def blur(self, img, name):
+        'Same as blur(img), written into the buffers of name'
+        shape = img.shape[:2]
+        gray = self.buffer(name + '_gray', shape)
+        blurred = self.buffer(name + '_blurred', shape)
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray)
+        cv2.GaussianBlur(gray, BLUR_SIZE, 0, dst=blurred)
+        return blurred
@@ -0,0 +1,176 @@
+'''Records what every frame did to a Session, and plays it back without the camera or the vision stages.
+
+    python camera.py --video run.mp4 --record run.rec     # play (and record) as usual
+    python recording.py run.rec                            # replay it, checking every frame
+    python recording.py run.rec --profile                  # the same, under cProfile
+
+A recording is a header followed by records, written as they happen (recording
+to an existing file starts it over):
+    frame: frame number, key, corners (all 0 when no maze was found), crop h and w,
+           fingerprint of the parsed maze (0 if none), whether it was valid,
+           and the checksum of the session after the frame
+    maze:  fingerprint and the maze (saved with save_maze), written the first time
+           a valid maze is seen, before the frame it was parsed on
+The game doesn't use randomness, so replaying the frames with the same mazes
+goes through exactly the same states, which the checksums confirm.
+'''
+import argparse
+import io
+import struct
+from hashlib import blake2b
+from time import perf_counter
+
+import numpy as np
+
+from build_the_maze import save_maze, load_maze
+from game import Session
+from timers import timers
+
+
+MAGIC = b'HAZYREC1'
+FRAME = struct.Struct('<cIiB8iHHQBI')
+MAZE = struct.Struct('<cQI')
+
+
+def fingerprint(maze):
+    'Hash of everything about a parsed maze that the game uses (its cells and where they are)'
+    h = blake2b(digest_size=8)
+    h.update(np.array(maze.maze_array.shape + maze.crop_shape(), dtype=np.int64).tobytes())
+    h.update(maze.maze_array.tobytes())
+    for positions in ([line.position for line in maze.vlines], [line.position for line in maze.hlines],
+                      maze.xgrid, maze.ygrid):
+        h.update(np.array(positions, dtype=np.int64).tobytes())
+    return int.from_bytes(h.digest(), 'little')
+
+
+class Recorder:
+    '''Writes the frames of one Session to path (replacing what was there). Set it as session.recorder
+       and process_maze logs every frame of that session'''
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.frames = 0
+        self.mazes = set()
+
+    def frame(self, session, corners, key, shape, maze, valid):
+        found = corners is not None
+        points = np.array(corners).reshape(8).tolist() if found else [0]*8
+        h, w = shape if found else (0, 0)
+
+        maze_fingerprint = 0
+        if maze is not None:
+            maze_fingerprint = fingerprint(maze)
+            # Only valid mazes can be played, the rest is never needed again
+            if valid is True and maze_fingerprint not in self.mazes:
+                data = io.BytesIO()
+                save_maze(maze, data)
+                self.file.write(MAZE.pack(b'M', maze_fingerprint, data.tell()) + data.getvalue())
+                self.mazes.add(maze_fingerprint)
+
+        self.file.write(FRAME.pack(b'F', self.frames, key, found, *points, h, w,
+                                   maze_fingerprint, valid is True, session.checksum()))
+        # So a crash doesn't lose the frames that led to it
+        self.file.flush()
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+
+class Frame:
+    'One frame of a recording'
+    def __init__(self, number, key, found, points, h, w, fingerprint, valid, checksum):
+        self.number = number
+        self.key = key
+        self.corners = np.array(points, dtype=np.int32).reshape(4, 1, 2) if found else None
+        self.shape = (h, w) if found else None
+        self.fingerprint = fingerprint
+        self.valid = bool(valid)
+        self.checksum = checksum
+
+
+def read_recording(path):
+    '''Reads a whole recording. Returns its frames and the mazes (Maze by fingerprint)'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f'{path} is not a recording')
+
+    frames = []
+    mazes = dict()
+    offset = len(MAGIC)
+    while offset < len(data):
+        tag = data[offset:offset+1]
+        if tag == b'F':
+            fields = FRAME.unpack_from(data, offset)
+            frames.append(Frame(fields[1], fields[2], fields[3], fields[4:12], *fields[12:]))
+            offset += FRAME.size
+        elif tag == b'M':
+            _, maze_fingerprint, size = MAZE.unpack_from(data, offset)
+            offset += MAZE.size
+            mazes[maze_fingerprint] = load_maze(io.BytesIO(data[offset:offset+size]))
+            offset += size
+        else:
+            raise ValueError(f'{path}: unknown record at byte {offset}')
+    return frames, mazes
+
+
+def replay(frames, mazes, session=None, check=True):
+    '''Drives session (a new one if None) through the recorded frames, without drawing anything.
+       check compares the session's checksum to the recorded one after every frame.
+       Returns a dict with the timings and the first frame that went differently (None if none did)'''
+    if session is None:
+        session = Session()
+    timers.reset()
+    mismatch = None
+    first = perf_counter()
+    for frame in frames:
+        maze = mazes.get(frame.fingerprint) if frame.valid else None
+        session.advance(frame.corners, maze, frame.valid, frame.key, frame.shape)
+        if check and mismatch is None and session.checksum() != frame.checksum:
+            mismatch = frame.number
+    seconds = perf_counter()-first
+
+    return {
+        'frames': len(frames),
+        'ticks': session.ticks,
+        'seconds': seconds,
+        'step': timers.totals.get('step', 0.0),
+        'ai': timers.totals.get('ai', 0.0),
+        'pathfinding': timers.totals.get('pathfinding', 0.0),
+        'mismatch': mismatch,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays a recording made with camera.py --record')
+    parser.add_argument('recording')
+    parser.add_argument('--repeat', type=int, default=1, help='replay it this many times (timings are of all of them)')
+    parser.add_argument('--profile', action='store_true', help='run the replay under cProfile')
+    args = parser.parse_args()
+
+    frames, mazes = read_recording(args.recording)
+    print(f'{len(frames)} frames, {len(mazes)} mazes')
+    timers.enabled = True
+
+    if args.profile:
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        profile.enable()
+    results = [replay(frames, mazes) for _ in range(args.repeat)]
+    if args.profile:
+        profile.disable()
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+
+    seconds = sum(r['seconds'] for r in results)
+    ticks = sum(r['ticks'] for r in results)
+    print(f'{ticks} ticks in {seconds:.3f}s ({ticks/seconds if seconds else 0:.1f} ticks/s)')
+    for phase in ['step', 'ai', 'pathfinding']:
+        total = sum(r[phase] for r in results)
+        print(f"  {phase:<12}{total:9.3f}s  {total/max(1, ticks)*1000:8.3f} ms/tick")
+    mismatches = [r['mismatch'] for r in results if r['mismatch'] is not None]
+    if mismatches:
+        print(f'Replay went differently from the recording on frame {mismatches[0]}')
+    else:
+        print('Every frame matched the recording')
@@ -0,0 +1,161 @@
+'''Plays hazymaze for clients that stream camera frames to it over TCP.
+
+    python server.py --port 8765 --workers 4
+    python server.py --timers       # print how long each stage took when stopped
+
+Every client gets its own Session. Messages are a header followed by a JPEG:
+    client -> server: FRAME header (frame id, key, size) + encoded frame
+    server -> client: REPLY header (frame id, processing ms, size) + encoded frame,
+                      size 0 when the frame was dropped
+Frames wait in a short queue per client. When a client sends faster than its frames
+can be processed, the oldest waiting frame is dropped, so the server always works on
+the newest frames instead of falling behind. Key presses are never dropped: they wait
+in order and each processed frame gets the oldest one.
+'''
+import argparse
+import asyncio
+import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
+import cv2
+
+from image_parsing import maze_boi
+from game import Session
+from timers import timers
+
+
+FRAME = struct.Struct('!IiI')   # frame id, key (-1 for none), size
+REPLY = struct.Struct('!IfI')   # frame id, processing ms, size (0 = dropped)
+
+
+def encode(img, quality=80):
+    ok, data = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return data.tobytes()
+
+
+def decode(data):
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+async def read_message(reader, header):
+    'Reads one header and its payload, returns (fields..., payload)'
+    fields = header.unpack(await reader.readexactly(header.size))
+    payload = await reader.readexactly(fields[-1]) if fields[-1] else b''
+    return (*fields[:-1], payload)
+
+
+def write_message(writer, header, *fields, payload=b''):
+    writer.write(header.pack(*fields, len(payload)) + payload)
+
+
+class FrameServer:
+    '''Runs maze_boi for every connected client on a shared pool of worker threads.
+       queue_size is how many frames a client can have waiting before the oldest one is dropped'''
+    def __init__(self, workers=None, queue_size=2, quality=80):
+        if queue_size < 1:
+            raise ValueError(f'queue_size must be at least 1, not {queue_size}')
+        self.workers = workers or os.cpu_count()
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.queue_size = queue_size
+        self.quality = quality
+        self.clients = 0
+        self.processed = 0
+        self.dropped = 0
+
+    def process(self, session, key, data):
+        'Runs on a worker thread: decode, play, encode'
+        t = perf_counter()
+        img = decode(data)
+        if img is None:
+            return 0.0, b''
+        # 't' would turn the timers (shared by every client) on or off, they are a server option
+        if key == ord('t'):
+            key = -1
+        output = maze_boi(img, key, session)
+        return (perf_counter()-t)*1000, encode(output, self.quality)
+
+    async def handle(self, reader, writer):
+        'One client: a task receiving its frames and this one processing them, newest first'
+        session = Session()
+        queue = deque()
+        # Key presses not played yet, oldest first
+        keys = deque()
+        arrived = asyncio.Event()
+        send_lock = asyncio.Lock()
+        closed = False
+        self.clients += 1
+
+        async def send(*fields, payload=b''):
+            async with send_lock:
+                write_message(writer, REPLY, *fields, payload=payload)
+                await writer.drain()
+
+        async def receive():
+            nonlocal closed
+            try:
+                while True:
+                    frame_id, key, data = await read_message(reader, FRAME)
+                    if key != -1:
+                        keys.append(key)
+                    if len(queue) >= self.queue_size:
+                        dropped_id, _ = queue.popleft()
+                        self.dropped += 1
+                        await send(dropped_id, 0.0)
+                    queue.append((frame_id, data))
+                    arrived.set()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                closed = True
+                arrived.set()
+
+        receiver = asyncio.create_task(receive())
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await arrived.wait()
+                arrived.clear()
+                while queue:
+                    frame_id, data = queue.popleft()
+                    key = keys.popleft() if keys else -1
+                    ms, output = await loop.run_in_executor(self.pool, self.process, session, key, data)
+                    self.processed += 1
+                    await send(frame_id, ms, payload=output)
+                if closed:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            receiver.cancel()
+            self.clients -= 1
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Serving on {host}:{port} with {self.workers} workers')
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='hazymaze frame server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, help='worker threads (default: all cores)')
+    parser.add_argument('--queue', type=int, default=2, help='frames waiting per client before dropping the oldest')
+    parser.add_argument('--quality', type=int, default=80, help='JPEG quality of the replies')
+    parser.add_argument('--timers', action='store_true', help='time the stages and print them when stopped')
+    args = parser.parse_args()
+    if args.queue < 1:
+        parser.error('--queue must be at least 1')
+    timers.enabled = args.timers
+
+    server = FrameServer(args.workers, args.queue, args.quality)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print(f'{server.processed} frames processed, {server.dropped} dropped')
+        for name, stage in timers.stats().items():
+            print(f"{name:<12}{stage['p50']:8.1f}{stage['p95']:8.1f}{stage['p99']:8.1f} ms (p50 p95 p99)")
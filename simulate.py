@@ -0,0 +1,102 @@
+'''Runs the game without a camera, for measuring how much the simulation costs.
+
+    python simulate.py --ticks 2000 --draw
+'''
+import argparse
+import pickle
+from time import perf_counter
+
+import numpy as np
+import cv2
+
+from game import Session
+from build_the_maze import load_maze
+from timers import timers
+
+
+def open_maze(path='maze.npz'):
+    'A maze saved with save_maze (.npz), or a pickled Maze'
+    if path.endswith('.npz'):
+        return load_maze(path)
+    with open(path, 'rb') as f:
+        maze = pickle.load(f)
+    # Old pickles were made before mazes had items
+    if not hasattr(maze, 'items'):
+        maze.items = []
+    return maze
+
+
+def run(maze, ticks=1000, draw=False, shape=None):
+    '''Loads maze into the game and steps it ticks times.
+       When the player is done (cheering or dead) the game is restarted.
+       shape is the (h, w) of the crop we pretend to see every frame.
+       Returns a dict with the timings and counters.'''
+    game = Session()
+    h, w = maze.crop_shape()
+    if shape is None:
+        shape = (h, w)
+
+    game.dump_maze(maze, h, w)
+    game.start()
+    timers.enabled = True
+    timers.reset()
+
+    if draw:
+        background = np.full((shape[0], shape[1], 3), 255, dtype=np.uint8)
+        layer, mask = maze.overlay(shape)
+        cv2.copyTo(layer, mask, background)
+        canvas = np.empty_like(background)
+    else:
+        canvas = None
+
+    restarts = 0
+    first = perf_counter()
+    for _ in range(ticks):
+        if game.player.action in ['cheering', 'dead'] and not game.cheering_dogs:
+            game.stop()
+            game.dump_maze(maze, h, w)
+            game.start()
+            restarts += 1
+
+        with timers.time('adjust_lines'):
+            game.adjust_lines(*shape)
+
+        if canvas is not None:
+            np.copyto(canvas, background)
+        game.step(canvas)
+    total = perf_counter()-first
+
+    return {
+        'ticks': ticks,
+        'seconds': total,
+        'ticks_per_second': ticks/total if total else np.inf,
+        'adjust_lines': timers.totals.get('adjust_lines', 0.0),
+        'ai': timers.totals.get('ai', 0.0),
+        'pathfinding': timers.totals.get('pathfinding', 0.0),
+        'units': timers.totals.get('units', 0.0),
+        'solver_calls': timers.counts.get('pathfinding', 0),
+        'restarts': restarts,
+    }
+
+
+def print_report(stats):
+    ticks = stats['ticks']
+    print(f"{ticks} ticks in {stats['seconds']:.3f}s ({stats['ticks_per_second']:.1f} ticks/s)")
+    # ai includes the time spent pathfinding
+    for phase in ['adjust_lines', 'ai', 'pathfinding', 'units']:
+        print(f"  {phase:<13}{stats[phase]:9.3f}s  {stats[phase]/ticks*1000:8.3f} ms/tick")
+    print(f"  astar calls  {stats['solver_calls']:9d}  {stats['solver_calls']/ticks:8.3f} per tick")
+    print(f"  restarts     {stats['restarts']:9d}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless game simulation benchmark')
+    parser.add_argument('--maze', default='maze.npz', help='saved (.npz) or pickled Maze to load')
+    parser.add_argument('--ticks', type=int, default=1000)
+    parser.add_argument('--draw', action='store_true', help='draw units onto an offscreen canvas')
+    parser.add_argument('--size', type=int, nargs=2, metavar=('H', 'W'),
+                        help='crop size to simulate (default: size the maze was parsed at)')
+    args = parser.parse_args()
+
+    maze = open_maze(args.maze)
+    print_report(run(maze, ticks=args.ticks, draw=args.draw, shape=args.size))
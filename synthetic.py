@@ -0,0 +1,146 @@
+'''Fake camera frames of printed mazes, for benchmarking the vision pipeline without a webcam.
+
+Every frame comes with its ground truth: the maze_array that maze_boi should recover.
+'''
+import numpy as np
+import cv2
+
+from maze_generator import perfect_maze, add_entrances, place_items
+
+
+RESOLUTIONS = {
+    '480p': (480, 640),
+    '720p': (720, 1280),
+    '1080p': (1080, 1920),
+    '1440p': (1440, 2560),
+    '4k': (2160, 3840),
+}
+
+
+def random_maze(rows, cols, smol=0, big=0, rng=None):
+    '''Perfect maze (recursive backtracker) as a maze_array:
+       1 is wall, 0 is walkable, 9 is a slime and 7 is a dog.
+       One entrance on the top row and one on the bottom row, smol slimes and big dogs.
+       maze_generator.generate_maze makes bigger and loopier ones'''
+    rng = np.random.default_rng(rng)
+    maze_array = perfect_maze(rows, cols, rng)
+    sides = add_entrances(maze_array, 2, rng)
+    place_items(maze_array, smol, big, rng, sides)
+    return maze_array
+
+
+def render_maze(maze_array, cell, margin, wall=None):
+    '''Draws maze_array as black lines on white paper.
+       Returns the paper image (BGR).'''
+    wall = wall or max(1, cell//10)
+    h = (maze_array.shape[0]//2)*cell + 2*margin
+    w = (maze_array.shape[1]//2)*cell + 2*margin
+    paper = np.full((h, w, 3), 255, dtype=np.uint8)
+
+    def point(y, x):
+        return (margin + (x//2)*cell, margin + (y//2)*cell)
+
+    for y, x in zip(*np.nonzero(maze_array == 1)):
+        if y % 2 == 0 and x % 2 == 1:
+            cv2.line(paper, point(y, x-1), point(y, x+1), (0, 0, 0), wall)
+        elif y % 2 == 1 and x % 2 == 0:
+            cv2.line(paper, point(y-1, x), point(y+1, x), (0, 0, 0), wall)
+
+    return paper
+
+
+def draw_items(paper, maze_array, cell, margin, smol_radius, big_radius):
+    'Draws slimes and dogs as red dots in the middle of their cells'
+    for y, x in zip(*np.nonzero(maze_array > 1)):
+        center = (margin + (x//2)*cell + cell//2, margin + (y//2)*cell + cell//2)
+        radius = smol_radius if maze_array[y, x] == 9 else big_radius
+        # Subpixel radius (shift=4 means coordinates are in 1/16ths of a pixel)
+        cv2.circle(paper, (center[0]*16, center[1]*16), int(radius*16), (40, 40, 200), -1,
+                   lineType=cv2.LINE_AA, shift=4)
+    return paper
+
+
+def item_radii(dim):
+    '''find_items tells slimes and dogs apart by their area relative to dim,
+       the (h+w)/2 of the cropped maze. Returns dot radii that land in the middle of each range.
+       Blurring and thresholding make a dot look wider than it was drawn,
+       by about 1.6px plus a bit more on small crops.'''
+    grow = 1.6 + 350/dim
+    smol_radius = max(0.5, np.sqrt(0.075*dim/np.pi) - grow)
+    big_radius = max(smol_radius+1, np.sqrt(0.2*dim/np.pi) - grow)
+    return smol_radius, big_radius
+
+
+def make_background(shape, rng):
+    'Dark table with some texture'
+    h, w = shape
+    base = rng.integers(30, 90, size=3)
+    small = rng.integers(-20, 20, size=(h//40+2, w//40+2, 3))
+    texture = cv2.resize(small.astype(np.float32), (w, h), interpolation=cv2.INTER_CUBIC)
+    return np.clip(base + texture, 0, 255).astype(np.uint8)
+
+
+def make_frame(maze_array, shape=(480, 640), coverage=0.75, tilt=0.08, light=0.35,
+               blur=1.0, noise=4.0, rng=None):
+    '''Puts a printed maze in a camera frame of the given (h, w) shape.
+       coverage: how much of the frame height the paper takes
+       tilt: how far the paper corners move (perspective), relative to paper size
+       light: strength of the lighting gradient (0 = flat)
+       blur: gaussian sigma in pixels; noise: gaussian noise sigma
+       Returns the frame and the 4 corners of the paper in the frame.'''
+    frame, corners = make_multi_frame([maze_array], shape, coverage, tilt, light, blur, noise, rng)
+    return frame, corners[0]
+
+
+def make_multi_frame(maze_arrays, shape=(480, 640), coverage=0.75, tilt=0.08, light=0.35,
+                     blur=1.0, noise=4.0, rng=None):
+    '''Same as make_frame with several printed mazes side by side.
+       Returns the frame and a list with the 4 corners of each paper.'''
+    rng = np.random.default_rng(rng)
+    h, w = shape
+    column = w/len(maze_arrays)
+
+    papers = []
+    all_corners = []
+    for i, maze_array in enumerate(maze_arrays):
+        cells_y, cells_x = maze_array.shape[0]//2, maze_array.shape[1]//2
+
+        # Size the paper so that it ends up covering the frame (or its column) as asked
+        cell = max(4, int(min(coverage*h/(cells_y+2), 0.9*column/(cells_x+2))))
+        margin = cell
+        paper = render_maze(maze_array, cell, margin)
+        ph, pw = paper.shape[:2]
+        draw_items(paper, maze_array, cell, margin, *item_radii((ph+pw)/2))
+
+        # Where the paper corners land: centered in its column, jittered by tilt
+        top, left = (h-ph)/2, i*column + (column-pw)/2
+        dst = np.float32([[left, top], [left+pw, top], [left, top+ph], [left+pw, top+ph]])
+        dst += rng.uniform(-tilt, tilt, size=(4, 2)).astype(np.float32)*np.float32([pw, ph])
+        dst[:, 0] = np.clip(dst[:, 0], 1, w-2)
+        dst[:, 1] = np.clip(dst[:, 1], 1, h-2)
+        papers.append(paper)
+        all_corners.append(dst)
+
+    frame = make_background(shape, rng)
+    for paper, dst in zip(papers, all_corners):
+        ph, pw = paper.shape[:2]
+        src = np.float32([[0, 0], [pw, 0], [0, ph], [pw, ph]])
+        matrix = cv2.getPerspectiveTransform(src, dst)
+        cv2.warpPerspective(paper, matrix, (w, h), dst=frame, borderMode=cv2.BORDER_TRANSPARENT)
+
+    # Lighting gradient in a random direction
+    if light:
+        angle = rng.uniform(0, 2*np.pi)
+        ys, xs = np.mgrid[0:h, 0:w].astype(np.float32)
+        ramp = (xs/w*np.cos(angle) + ys/h*np.sin(angle))
+        ramp = (ramp - ramp.min()) / (ramp.max() - ramp.min() + 1e-6)
+        gain = 1.0 - light*ramp
+        frame = (frame * gain[..., None]).astype(np.uint8)
+
+    if blur:
+        frame = cv2.GaussianBlur(frame, (0, 0), blur)
+
+    if noise:
+        frame = np.clip(frame + rng.normal(0, noise, size=frame.shape), 0, 255).astype(np.uint8)
+
+    return frame, all_corners
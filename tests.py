@@ -1,15 +1,45 @@
+import asyncio
+import copy
+import os
 import pickle
+import tempfile
+import threading
 import unittest
+from unittest import mock
+
+import numpy as np
+import cv2
 
 from maze_solver import astar
+from extract_lines import group_lines, find_maze, find_mazes, find_lines, find_items
+from build_the_maze import Maze, Line, MazeCache, RECOMPRESS_LIMIT, copy_cases, save_maze, load_maze
+from game import Session
+from recording import Recorder, read_recording, replay
+from maze_generator import generate_maze, maze_lines
+from governor import Governor
+from helpers import Workspace, blend_non_transparent, crop_from_points, ChangeGate
+from preprocessing import BufferPool, blur
+from image_parsing import parse_maze, ParseWorker, MazeGroup, match_slots
+from synthetic import random_maze, make_frame, make_multi_frame
+from load_images import Assets, save_sprite_pack
+from frame_sources import ImageDirSource
+from server import FrameServer, FRAME, REPLY, read_message, write_message, encode
+from timers import timers
 
 
-class MazeSolverTest(unittest.TestCase):
+def synthetic_crop(seed, rows=6, cols=6):
+    'The cropped maze of a synthetic 480p frame of a random maze, and the maze_array it should parse to'
+    rng = np.random.default_rng(seed)
+    truth = random_maze(rows, cols, smol=1, big=1, rng=rng)
+    frame, _ = make_frame(truth, (480, 640), rng=rng)
+    _, corners = find_maze(frame)
+    crop, _ = crop_from_points(frame, corners)
+    return crop, truth
 
-    def test_maze(self):
-        with open('pickled_maze', 'rb') as f:
-            maze = pickle.load(f)
 
+class MazeSolverTest(unittest.TestCase):
+
+    def solve(self, maze):
         # Get the entrance and the exit
         for case in maze.case_array[0]:
             if case != 0:
@@ -32,6 +62,639 @@ class MazeSolverTest(unittest.TestCase):
 
         self.assertEquals(distance, expected_distance)
 
+    def test_maze(self):
+        with open('pickled_maze', 'rb') as f:
+            maze = pickle.load(f)
+        self.solve(maze)
+
+    def test_saved_maze(self):
+        self.solve(load_maze('maze.npz'))
+
+    def test_save_load(self):
+        with open('pickled_maze', 'rb') as f:
+            maze = pickle.load(f)
+        maze.items = [((1, 1), 'smol'), ((3, 5), 'big')]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'maze.npz')
+            save_maze(maze, path)
+            loaded = load_maze(path)
+
+        self.assertTrue(np.array_equal(loaded.maze_array, maze.maze_array))
+        self.assertEqual(loaded.entrances, maze.entrances)
+        self.assertEqual(loaded.items, maze.items)
+        self.assertEqual((loaded.xgrid, loaded.ygrid), (maze.xgrid, maze.ygrid))
+        self.assertEqual([line.position for line in loaded.vlines], [line.position for line in maze.vlines])
+        for case in maze.case_array.flat:
+            if case != 0:
+                copy = loaded.case_array[case.position]
+                self.assertEqual((copy.value, copy.corridor, copy.entrance, copy.nearby_squares),
+                                 (case.value, case.corridor, case.entrance, case.nearby_squares))
+                self.assertEqual([(other.position, distance) for other, distance in copy.paths],
+                                 [(other.position, distance) for other, distance in case.paths])
+
+
+class GroupLinesTest(unittest.TestCase):
+
+    def test_group_lines(self):
+        # HoughLinesP segments: x, y1, x2, y2 (covering y2 to y1)
+        segments = np.array([[[5, 8, 5, 2]], [[1, 4, 1, 0]], [[6, 10, 6, 9]], [[2, 6, 2, 5]]])
+        lines = group_lines(segments, 'v', 10)
+
+        self.assertEqual([line.position for line in lines], [2, 6])
+        self.assertEqual([line.kind for line in lines], ['v', 'v'])
+        self.assertEqual(list(np.flatnonzero(lines[0].array)), [0, 1, 2, 3, 5])
+        self.assertEqual(list(np.flatnonzero(lines[1].array)), [2, 3, 4, 5, 6, 7, 9])
+
+    def test_no_lines(self):
+        self.assertIsNone(group_lines(None, 'h', 10))
+
+
+class CopyCasesTest(unittest.TestCase):
+
+    def test_copy_cases(self):
+        maze = load_maze('maze.npz')
+        copied = copy_cases(maze.case_array)
+
+        start, end = maze.entrances[0], maze.entrances[1]
+        path, distance = astar(maze, maze.case_array[start], maze.case_array[end])
+        copied_path, copied_distance = astar(maze, copied[start], copied[end], clear=False)
+
+        self.assertEqual([case.position for case in copied_path], [case.position for case in path])
+        self.assertEqual(copied_distance, distance)
+        # Walking the copy doesn't touch the original cases
+        self.assertTrue(all(case.back is None for case in maze.case_array.flat if case != 0))
+        self.assertFalse(set(map(id, copied_path)) & set(map(id, path)))
+
+
+class RecompressTest(unittest.TestCase):
+
+    def graph(self, case_array):
+        return {case.position: (case.corridor, case.entrance,
+                                sorted((other.position, distance) for other, distance in case.paths))
+                for case in case_array.flat if case != 0}
+
+    def test_recompress_maze(self):
+        maze = load_maze('maze.npz')
+        rebuilt = load_maze('maze.npz')
+
+        # Open a wall between two cells and put another one up
+        edited = maze.maze_array.copy()
+        edited[2, 3], edited[5, 6] = 1 - edited[2, 3], 1 - edited[5, 6]
+        old_maze_array = maze.maze_array
+        maze.maze_array = edited
+        self.assertTrue(maze.recompress_maze(old_maze_array, maze.case_array, maze.entrances))
+
+        rebuilt.maze_array = edited.copy()
+        rebuilt.compress_maze([])
+        self.assertEqual(maze.entrances, rebuilt.entrances)
+        self.assertEqual(self.graph(maze.case_array), self.graph(rebuilt.case_array))
+
+    def test_last_maze_is_not_patched(self):
+        last = load_maze('maze.npz')
+        before = self.graph(last.case_array)
+        session = Session()
+        key = (last.maze_array.shape, last.maze_array.tobytes())
+        session.built_mazes[key] = (last.case_array, last.entrances, last.items)
+        session.last_built = (key, last.maze_array, last.case_array, last.entrances)
+
+        maze = load_maze('maze.npz')
+        maze.maze_array = maze.maze_array.copy()
+        maze.maze_array[2, 3] = 1 - maze.maze_array[2, 3]
+        self.assertTrue(maze.recompress_last(session))
+        self.assertIsNot(maze.case_array, last.case_array)
+        # Anything still holding the last maze (a parse result, built_mazes) keeps its graph
+        self.assertEqual(self.graph(last.case_array), before)
+        self.assertIs(session.built_mazes[key][0], last.case_array)
+
+
+    def test_falls_back_to_compress_maze(self):
+        session = Session(maze_cache=MazeCache())
+
+        def build(maze_array):
+            vlines, hlines, items = maze_lines(maze_array, cell=8)
+            maze = Maze(vlines, hlines)
+            maze.get_walkable_grid()
+            with mock.patch.object(Maze, 'compress_maze', autospec=True, side_effect=Maze.compress_maze) as compress:
+                maze.build_maze(items, session=session)
+            return maze, compress.called
+
+        first = generate_maze(10, 10, loops=0.2, entrances=2, rng=0)
+        self.assertTrue(build(first)[1])
+
+        # One wall changed: patched
+        edited = first.copy()
+        edited[1, 2] = 1 - edited[1, 2]
+        maze, compressed = build(edited)
+        self.assertFalse(compressed)
+
+        # Every inner wall flipped: too many changes to patch, so it is built from scratch
+        other = edited.copy()
+        other[1:-1:2, 2:-1:2] ^= 1
+        other[2:-1:2, 1:-1:2] ^= 1
+        self.assertGreater(np.count_nonzero(other != edited), RECOMPRESS_LIMIT*other.size)
+        probe = copy.copy(maze)
+        probe.maze_array = other
+        self.assertFalse(probe.recompress_maze(edited, copy_cases(maze.case_array), maze.entrances))
+        rebuilt, compressed = build(other)
+        self.assertTrue(compressed)
+        self.assertTrue(np.array_equal(rebuilt.maze_array, other))
+
+
+class MazeGeometryTest(unittest.TestCase):
+
+    def test_real_position(self):
+        maze = load_maze('maze.npz')
+
+        self.assertEqual(maze.real_position(0, 0), (maze.hlines[0].position, maze.vlines[0].position))
+        self.assertEqual(maze.real_position(3, 5), (maze.ygrid[1], maze.xgrid[2]))
+        self.assertEqual(maze.real_position(41, 0), (None, None))
+
+        # Rescaling moves every row and column at once
+        maze.geometry.rescale(0.5, 2)
+        self.assertEqual(maze.real_position(3, 5), (int(round(maze.ygrid[1]*0.5)), int(round(maze.xgrid[2]*2))))
+        ys, xs = maze.geometry.positions([0, 3], [0, 5])
+        self.assertEqual(list(ys), [int(round(maze.hlines[0].position*0.5)), int(round(maze.ygrid[1]*0.5))])
+
+
+class OverlayTest(unittest.TestCase):
+
+    def draw_maze_at(self, maze, shape):
+        'What draw_maze and draw_items give on a crop of shape, with the lines moved and stretched to it'
+        (ch, cw), (h, w) = maze.crop_shape(), shape
+        maze = copy.copy(maze)
+        maze._geometry = None
+        maze.geometry.rescale(h/ch, w/cw)
+
+        def stretched(line, length, proportion):
+            array = cv2.resize(np.uint8(line.array != 0)[None], (length, 1), interpolation=cv2.INTER_NEAREST)[0]
+            return Line(array, int(np.rint(line.position*proportion)), line.kind)
+        maze.vlines = [stretched(line, h, w/cw) for line in maze.vlines]
+        maze.hlines = [stretched(line, w, h/ch) for line in maze.hlines]
+        image = np.zeros(shape + (3,), dtype=np.uint8)
+        maze.draw_maze(image)
+        maze.draw_items(image)
+        return image
+
+    def test_same_as_draw_maze(self):
+        maze = load_maze('maze.npz')
+        h, w = maze.crop_shape()
+        for shape in [(h, w), (h-1, w-3), (h-7, w-11), (h-20, w-20), (h+5, w+9)]:
+            layer, mask = maze.overlay(shape)
+            expected = self.draw_maze_at(maze, shape)
+            self.assertTrue(np.array_equal(layer, expected), shape)
+            self.assertTrue(np.array_equal(mask, expected.any(axis=2)), shape)
+
+
+class RecordingTest(unittest.TestCase):
+
+    def test_replay(self):
+        maze = load_maze('maze.npz')
+        corners = np.array([[[0, 0]], [[100, 0]], [[0, 100]], [[100, 100]]])
+        shape = maze.crop_shape()
+        # Find the maze, start it, play, lose it for a bit, find it again and stop it
+        script = [(corners, -1)]*3 + [(corners, 32)] + [(corners, -1)]*40 + [(None, -1)]*3 + \
+                 [(corners, -1)]*20 + [(corners, 32)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'session.rec')
+            # Recording a second run to the same path starts the recording over
+            for run in range(2):
+                session = Session()
+                session.recorder = Recorder(path)
+                for frame_corners, key in script:
+                    looking = session.playing is False or session.pause is True
+                    parsed = maze if looking and frame_corners is not None else None
+                    session.advance(frame_corners, parsed, parsed is not None, key, shape)
+                    session.recorder.frame(session, frame_corners, key, shape, parsed, parsed is not None)
+                session.recorder.close()
+            frames, mazes = read_recording(path)
+
+        self.assertEqual(len(frames), len(script))
+        self.assertEqual(len(mazes), 1)
+        result = replay(frames, mazes)
+        self.assertIsNone(result['mismatch'])
+        self.assertEqual(result['ticks'], session.ticks)
+
+        # A different key press makes it go differently
+        frames[10].key = 32
+        self.assertEqual(replay(frames, mazes)['mismatch'], 10)
+
+
+class MazeGeneratorTest(unittest.TestCase):
+
+    def test_lines_build_the_same_maze(self):
+        maze_array = generate_maze(15, 20, loops=0.2, entrances=4, smol=0.05, big=0.05, rng=0)
+        self.assertEqual(maze_array.shape, (31, 41))
+        self.assertEqual(np.count_nonzero(maze_array == 9), 15)
+
+        vlines, hlines, items = maze_lines(maze_array, cell=8)
+        maze = Maze(vlines, hlines)
+        maze.get_walkable_grid()
+        maze.build_maze(items)
+
+        self.assertTrue(np.array_equal(maze.maze_array, maze_array))
+        self.assertEqual(len(maze.entrances), 4)
+        self.assertTrue(maze.is_valid())
+
+
+class GovernorTest(unittest.TestCase):
+
+    def test_levels(self):
+        # No smoothing, so every frame counts in full
+        governor = Governor(target_ms=50, smoothing=1, cooldown=2, up_after=5)
+        # Too slow: one level down at a time, waiting for the average in between
+        for _ in range(7):
+            governor.update(100)
+        self.assertEqual(governor.level, 3)
+        self.assertFalse(governor.quality.soft_blend)
+
+        # Plenty of headroom: back up after up_after frames under it
+        levels = [governor.update(10) for _ in range(8)]
+        self.assertEqual(levels[-1], 2)
+
+        # Going up made it too slow again right away, so the next try waits longer
+        self.assertEqual(governor.update(100), 2)    # still waiting after the change
+        governor.update(100)
+        self.assertEqual(governor.level, 3)
+        self.assertEqual(governor.up_after, 10)
+        self.assertEqual(governor.stats()['changes'], 5)
+
+
+class WorkspaceTest(unittest.TestCase):
+
+    def test_shape(self):
+        workspace = Workspace(long_side=640, step=16)
+        self.assertEqual(workspace.shape(1500, 1000), (640, 432))
+        # The maze moving a bit on screen keeps the same shape
+        self.assertEqual(workspace.shape(1480, 1010), (640, 432))
+        # Smaller than the workspace: it keeps its own size
+        self.assertEqual(workspace.shape(300, 200), (304, 208))
+        # A different maze
+        self.assertEqual(workspace.shape(1000, 2000), (320, 640))
+
+
+class BufferPoolTest(unittest.TestCase):
+
+    def test_blend_reuses_buffers(self):
+        rng = np.random.default_rng(0)
+        frame = rng.integers(0, 256, (60, 80, 3), dtype=np.uint8)
+        game = np.zeros_like(frame)
+        game[10:50, 20:60] = rng.integers(1, 256, (40, 40, 3), dtype=np.uint8)
+
+        pool = BufferPool()
+        blended = blend_non_transparent(frame, game, pool).copy()
+        allocations = pool.allocations
+        # Same result as without a pool, and nothing new allocated the second time
+        self.assertTrue(np.array_equal(blended, blend_non_transparent(frame, game)))
+        self.assertTrue(np.array_equal(blended, blend_non_transparent(frame, game, pool)))
+        self.assertEqual(pool.allocations, allocations)
+
+        pool.buffer('blend', (30, 40, 3))
+        self.assertEqual(pool.allocations, allocations+1)
+
+
+class ParseWorkerTest(unittest.TestCase):
+
+    def test_same_as_parsing_here(self):
+        rng = np.random.default_rng(0)
+        frame, _ = make_frame(random_maze(6, 6, smol=1, big=1, rng=rng), (480, 640), rng=rng)
+        _, corners = find_maze(frame)
+        crop, _ = crop_from_points(frame, corners)
+        blurred = blur(crop)
+
+        session = Session()
+        worker = ParseWorker(session)
+        try:
+            self.assertEqual(worker.result, (None, False, 0))
+            worker.submit(crop, blurred)
+            self.assertTrue(worker.wait(timeout=30))
+            maze, valid, _ = worker.result
+            expected, expected_valid = parse_maze(crop, blurred)
+            self.assertTrue(np.array_equal(maze.maze_array, expected.maze_array))
+            self.assertEqual(valid, expected_valid)
+
+            worker.reset()
+            self.assertIsNone(worker.result[0])
+
+            # A frame holding the lock (reading result and stepping the game) sees no new result
+            with worker.lock:
+                worker.submit(crop, blurred)
+                self.assertFalse(worker.wait(timeout=1))
+                self.assertIsNone(worker.result[0])
+            self.assertTrue(worker.wait(timeout=30))
+            self.assertIsNotNone(worker.result[0])
+        finally:
+            worker.close()
+
+    def test_parse_that_raises(self):
+        crop, _ = synthetic_crop(0)
+        blurred = blur(crop)
+        worker = ParseWorker(Session())
+        try:
+            with mock.patch('image_parsing.build_parsed_maze', side_effect=ValueError('broken')):
+                worker.submit(crop, blurred)
+                # Raised to whoever asks first, once
+                with self.assertRaises(ValueError):
+                    worker.wait(timeout=30)
+            self.assertFalse(worker.busy)
+            self.assertEqual(worker.result, (None, False, 0))
+
+            # Or by a frame reading the result
+            with mock.patch('image_parsing.find_maze_parts', side_effect=ValueError('broken')):
+                worker.submit(crop, blurred)
+                with worker.condition:
+                    worker.condition.wait_for(lambda: worker.job is None and not worker.busy, 30)
+                with self.assertRaises(ValueError):
+                    worker.result
+            self.assertTrue(worker.wait(timeout=30))
+
+            # The thread is still there for the next crops
+            worker.submit(crop, blurred)
+            self.assertTrue(worker.wait(timeout=30))
+            self.assertIsNotNone(worker.result[0])
+        finally:
+            worker.close()
+
+
+class SpritePackTest(unittest.TestCase):
+
+    def test_pack_is_the_sheets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sprites.pack')
+            save_sprite_pack(path)
+            packed, sheets = Assets(path), Assets(None)
+            self.assertEqual(packed.source, 'pack')
+            for name in ['player', 'slime', 'dog', 'heart']:
+                for a, b in zip(getattr(packed, name), getattr(sheets, name)):
+                    self.assertTrue(np.array_equal(a, b))
+            del packed
+        # No pack, the sheets are loaded instead
+        self.assertEqual(Assets(path).source, 'sheets')
+
+    def test_session_loads_sprites_when_playing(self):
+        session = Session()
+        self.assertIsNone(session._assets)
+        self.assertIs(session.player_sprite, session.assets.player)
+
+
+class MemoryTimersTest(unittest.TestCase):
+
+    def tearDown(self):
+        timers.track_memory(False)
+        timers.enabled = False
+        timers.reset()
+
+    def test_stage_allocations(self):
+        timers.reset()
+        timers.track_memory()
+        kept = []
+        with timers.time('outer'):
+            with timers.time('inner'):
+                # Allocated and thrown away: counts for the peak, not for what's retained
+                np.ones(1_000_000, dtype=np.uint8)
+            kept.append(np.ones(200_000, dtype=np.uint8))
+
+        stats = timers.stats()
+        self.assertGreaterEqual(stats['inner']['alloc_p50'], 1_000_000)
+        self.assertLess(stats['inner']['retained'], 100_000)
+        # The inner block's peak is the outer one's too
+        self.assertGreaterEqual(stats['outer']['alloc_p50'], 1_000_000)
+        self.assertGreaterEqual(stats['outer']['retained'], 200_000)
+        self.assertIn('Case', stats['mazes'])
+
+    def test_draw_skips_the_gauges(self):
+        timers.reset()
+        timers.track_memory()
+        calls = []
+        timers.gauge('calls', lambda: calls.append(1) or {'calls': len(calls)})
+        try:
+            with timers.time('stage'):
+                pass
+            timers.draw(np.zeros((100, 200, 3), np.uint8))
+            self.assertEqual(calls, [])
+            self.assertIn('calls', timers.stats())
+            self.assertNotIn('calls', timers.stats(gauges=False))
+        finally:
+            del timers.gauges['calls']
+
+
+class FindLinesTest(unittest.TestCase):
+
+    def test_projection_matches_hough(self):
+        for seed in range(4):
+            crop, _ = synthetic_crop(seed)
+            _, item_mask = find_items(crop)
+            hough = find_lines(crop, item_mask, method='hough')
+            projection = find_lines(crop, item_mask, method='projection')
+            for hough_lines, projection_lines in zip(hough, projection):
+                self.assertEqual(len(hough_lines), len(projection_lines))
+                for a, b in zip(hough_lines, projection_lines):
+                    self.assertLessEqual(abs(a.position-b.position), 2)
+                    # Where the wall starts and stops can be a few pixels off
+                    self.assertLessEqual(np.count_nonzero(a.array != b.array), 0.03*len(a.array))
+
+
+class FindItemsTest(unittest.TestCase):
+
+    def test_components_match_contours(self):
+        for seed in range(6):
+            crop, _ = synthetic_crop(seed)
+            blurred = blur(crop)
+            contour_items, contour_mask = find_items(crop, blurred, method='contours')
+            component_items, component_mask = find_items(crop, blurred, method='components')
+
+            self.assertEqual([kind for _, kind in contour_items], [kind for _, kind in component_items])
+            for (a, _), (b, _) in zip(contour_items, component_items):
+                self.assertLessEqual(np.abs(a-b).max(), 2)
+            # The contours go around the blobs, through the pixels next to them
+            self.assertFalse(np.any(component_mask & ~contour_mask))
+            self.assertFalse(np.any(contour_mask & ~cv2.dilate(component_mask, np.ones((3, 3), np.uint8))))
+
+
+class ChangeGateTest(unittest.TestCase):
+
+    def test_threshold(self):
+        gate = ChangeGate(threshold=8.0)
+        gray = np.full((100, 100), 100, np.uint8)
+        self.assertTrue(gate.changed(gray))
+        # A little brighter is the same image, a lot brighter is a change
+        self.assertFalse(gate.changed(gray+5))
+        self.assertTrue(gate.changed(gray+20))
+        # Compared to the last one let through (gray+20), not to the first
+        self.assertFalse(gate.changed(gray+25))
+
+    def test_max_skips(self):
+        gate = ChangeGate(max_skips=3)
+        gray = np.full((100, 100), 100, np.uint8)
+        let_through = [gate.changed(gray) for _ in range(9)]
+        self.assertEqual(let_through, [True, False, False, False, True, False, False, False, True])
+
+        gate.reset()
+        self.assertTrue(gate.changed(gray))
+
+    def test_shape_tolerance(self):
+        gate = ChangeGate(shape_tolerance=0.05)
+        self.assertTrue(gate.changed(np.full((100, 200), 100, np.uint8)))
+        # Jitter of up to 5% of each side is the same crop
+        self.assertFalse(gate.changed(np.full((104, 192), 100, np.uint8)))
+        self.assertTrue(gate.changed(np.full((106, 200), 100, np.uint8)))
+        self.assertTrue(gate.changed(np.full((106, 188), 100, np.uint8)))
+
+
+class MatchSlotsTest(unittest.TestCase):
+
+    def test_slots_follow_their_maze(self):
+        rng = np.random.default_rng(0)
+        mazes = [random_maze(5, 5, smol=1, big=1, rng=rng) for _ in range(2)]
+        frame, _ = make_multi_frame(mazes, (480, 640), rng=rng)
+        h, w = frame.shape[:2]
+        left_only = frame.copy()
+        left_only[:, w//2:] = frame[:, -10:].mean(axis=(0, 1))
+        right_only = frame.copy()
+        right_only[:, :w//2] = frame[:, :10].mean(axis=(0, 1))
+        moved = cv2.warpAffine(frame, np.float32([[1, 0, -20], [0, 1, 10]]), (w, h), borderMode=cv2.BORDER_REPLICATE)
+
+        group = MazeGroup(workers=1)
+        try:
+            def slots(img):
+                'The slot given to the left and the right maze of img (None if not there)'
+                _, all_corners = find_mazes(img)
+                found = {}
+                for slot, corners in match_slots(group, all_corners):
+                    if corners is not None:
+                        side = 'left' if np.array(corners).reshape(4, 2)[:, 0].mean() < w/2 else 'right'
+                        found[side] = slot
+                return found.get('left'), found.get('right')
+
+            left, right = slots(left_only)
+            self.assertIsNotNone(left)
+            self.assertIsNone(right)
+
+            # The second maze shows up: it gets a new slot, the first one keeps its own
+            self.assertIs(slots(frame)[0], left)
+            right = group.slots[-1]
+            self.assertIsNot(left, right)
+            self.assertEqual(len(group.slots), 2)
+
+            self.assertEqual(slots(moved), (left, right))
+            self.assertEqual(slots(right_only), (None, right))
+            self.assertEqual(left.missing, 1)
+            self.assertEqual(slots(frame), (left, right))
+            self.assertEqual(len(group.slots), 2)
+        finally:
+            group.close()
+
+
+class StalledServer(FrameServer):
+    'A FrameServer whose first frame takes until release is set, and that remembers the keys it played'
+    def __init__(self, queue_size):
+        super().__init__(workers=1, queue_size=queue_size)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.played = []
+
+    def process(self, session, key, data):
+        self.started.set()
+        self.release.wait(timeout=10)
+        self.played.append((data, key))
+        return 0.0, b'done'
+
+
+class FrameServerTest(unittest.TestCase):
+
+    def play(self, queue_size, keys, later=()):
+        '''Sends a frame per key while the first one is stuck, then one per key of later, each after
+           the reply to the one before. Returns the dropped and the played frames'''
+        server = StalledServer(queue_size)
+
+        async def client():
+            listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for frame_id, key in enumerate(keys):
+                write_message(writer, FRAME, frame_id, key, payload=str(frame_id).encode())
+                await writer.drain()
+                if frame_id == 0:
+                    await asyncio.to_thread(server.started.wait, 10)
+
+            replies = []
+            dropped = max(0, len(keys)-1-queue_size)
+            while len(replies) < len(keys):
+                if len(replies) == dropped:
+                    server.release.set()
+                replies.append(await read_message(reader, REPLY))
+            for frame_id, key in enumerate(later, len(keys)):
+                write_message(writer, FRAME, frame_id, key, payload=str(frame_id).encode())
+                await writer.drain()
+                replies.append(await read_message(reader, REPLY))
+            writer.close()
+            listener.close()
+            await listener.wait_closed()
+            return replies
+
+        try:
+            replies = asyncio.run(asyncio.wait_for(client(), timeout=30))
+        finally:
+            server.release.set()
+            server.pool.shutdown()
+        dropped = [frame_id for frame_id, _, output in replies if not output]
+        played = [(int(data), key) for data, key in server.played]
+        self.assertEqual(server.dropped, len(dropped))
+        self.assertEqual([frame_id for frame_id, _, output in replies if output], [frame_id for frame_id, _ in played])
+        return dropped, played
+
+    def test_drops_the_oldest(self):
+        a = ord('a')
+        dropped, played = self.play(2, [-1, a, -1, -1, -1])
+        self.assertEqual(dropped, [1, 2])
+        # The key of the dropped frame 1 goes to the next frame played
+        self.assertEqual(played, [(0, -1), (3, a), (4, -1)])
+
+    def test_key_moves_to_the_new_frame(self):
+        a = ord('a')
+        dropped, played = self.play(1, [-1, a, -1])
+        self.assertEqual(dropped, [1])
+        # With nothing else waiting, the arriving frame gets the key
+        self.assertEqual(played, [(0, -1), (2, a)])
+
+    def test_clients_cant_turn_the_timers_on(self):
+        server = FrameServer(workers=1)
+        try:
+            frame = encode(np.full((120, 160, 3), 90, np.uint8))
+            server.process(Session(), ord('t'), frame)
+            self.assertFalse(timers.enabled)
+            self.assertFalse(timers.overlay)
+        finally:
+            server.pool.shutdown()
+        with self.assertRaises(ValueError):
+            FrameServer(queue_size=0)
+
+    def test_no_key_is_lost(self):
+        a, b, c = ord('a'), ord('b'), ord('c')
+        dropped, played = self.play(2, [-1, a, b, c], later=[-1])
+        self.assertEqual(dropped, [1])
+        # More keys than frames played: they wait, in order, for the next frames
+        self.assertEqual(played, [(0, -1), (2, a), (3, b), (4, c)])
+
+
+class ImageDirSourceTest(unittest.TestCase):
+
+    def test_skips_unreadable_images(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for i in range(4):
+                cv2.imwrite(os.path.join(directory, f'{i}.png'), np.full((8, 8, 3), i, np.uint8))
+            with open(os.path.join(directory, '2.png'), 'wb') as f:
+                f.write(b'not a png')
+
+            with mock.patch('sys.stderr'):
+                frames = list(ImageDirSource(directory).frames(paced=False))
+                self.assertEqual([int(img[0, 0, 0]) for img in frames], [0, 1, 3])
+
+                for i in range(4):
+                    with open(os.path.join(directory, f'{i}.png'), 'wb') as f:
+                        f.write(b'not a png')
+                self.assertIsNone(ImageDirSource(directory, loop=True).read())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,203 @@
+'''Named timers for the stages of maze_boi and the game.
+
+    from timers import timers
+
+    with timers.time('lines'):
+        vlines, hlines = find_lines(img_cropped_maze, item_mask)
+
+    timers.stats()  # {'lines': {'p50': ..., 'p95': ..., 'p99': ..., 'count': ..., 'total': ...}, ...}
+
+The stages are timed under these names (each name is one stage only, so its percentiles mean something):
+    frame       all of maze_boi
+    detect      find_maze on the frame
+    crop        warping the maze out of the frame
+    preprocess  gray + blur of the crop
+    items, lines, build, validate   parsing the maze
+    overlay     pasting the walls and items of the parsed maze on the crop
+    step        a tick of the game (ai and pathfinding are inside it, and so is units)
+    ai, pathfinding
+    units       drawing the units on the crop
+    warp_back   warping the crop back to the frame
+    blend       pasting it on the frame
+
+Timers are off by default, and when off timers.time() hands back a do-nothing context
+so leaving them in the code costs next to nothing.
+
+They can also measure memory (with tracemalloc, which slows everything down a lot):
+
+    timers.track_memory()
+    timers.stats()  # {'lines': {..., 'alloc_p50': ..., 'alloc_p95': ..., 'retained': ...}, ..., 'mazes': {...}}
+
+alloc is how many bytes the stage had allocated at its peak (above what there was when it started),
+retained how many more bytes there were after it than before, added up over every time it ran.
+The gauges (see gauge()) are also in the stats then, like the live Maze and Case objects.
+tracemalloc counts the allocations of every thread together, so memory is only
+right for stages that don't run at the same time as others.
+'''
+import tracemalloc
+from collections import deque
+from contextlib import nullcontext
+from threading import Lock, local
+from time import perf_counter
+
+import numpy as np
+import cv2
+
+
+_off = nullcontext()
+
+
+class _Timer:
+    __slots__ = ('timers', 'name', 'start')
+
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timers.add(self.name, perf_counter()-self.start)
+        return False
+
+
+class _MemoryTimer(_Timer):
+    'Also measures the memory allocated in its block'
+    __slots__ = ('current', 'peak')
+
+    def __enter__(self):
+        stack = self.timers.stack()
+        current, peak = tracemalloc.get_traced_memory()
+        # The peak is reset for this block, the one it's in keeps what it had reached so far
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, peak)
+        tracemalloc.reset_peak()
+        self.current = current
+        self.peak = current
+        stack.append(self)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = perf_counter()-self.start
+        current, peak = tracemalloc.get_traced_memory()
+        self.timers.stack().pop()
+        self.timers.add(self.name, seconds, max(peak, self.peak)-self.current, current-self.current)
+        return False
+
+
+class Timers:
+    def __init__(self, window=300):
+        # Percentiles are taken over the last `window` samples of each timer
+        self.window = window
+        self.enabled = False
+        # Whether maze_boi should write the stats on the frame
+        self.overlay = False
+        # Stages of different mazes can be timed from different threads
+        self.lock = Lock()
+        # Whether they measure memory too, and the blocks each thread is in (see track_memory)
+        self.memory = False
+        self.started_tracing = False
+        self.stacks = local()
+        # Functions giving numbers to add to the stats when measuring memory (see gauge)
+        self.gauges = dict()
+        self.reset()
+
+    def reset(self):
+        self.samples = dict()
+        self.counts = dict()
+        self.totals = dict()
+        self.allocated = dict()
+        self.retained = dict()
+
+    def time(self, name):
+        'Context manager that times its block under name (does nothing if disabled)'
+        if not self.enabled:
+            return _off
+        if self.memory:
+            return _MemoryTimer(self, name)
+        return _Timer(self, name)
+
+    def track_memory(self, on=True):
+        'Turns the timers on and makes them measure memory too (or stops measuring it)'
+        if on:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            self.enabled = True
+        elif self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        self.memory = on
+
+    def stack(self):
+        if not hasattr(self.stacks, 'blocks'):
+            self.stacks.blocks = []
+        return self.stacks.blocks
+
+    def gauge(self, name, function):
+        'function() (a dict of numbers) goes in the stats under name when measuring memory'
+        self.gauges[name] = function
+
+    def add(self, name, seconds, allocated=None, retained=None):
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+                self.counts[name] = 0
+                self.totals[name] = 0.0
+            self.samples[name].append(seconds)
+            self.counts[name] += 1
+            self.totals[name] += seconds
+            if allocated is not None:
+                if name not in self.allocated:
+                    self.allocated[name] = deque(maxlen=self.window)
+                    self.retained[name] = 0
+                self.allocated[name].append(allocated)
+                self.retained[name] += retained
+
+    def percentiles(self, name):
+        'p50, p95 and p99 of the recent samples of name, in milliseconds'
+        with self.lock:
+            samples = np.array(self.samples.get(name, ()))
+        if not samples.size:
+            return None
+        p50, p95, p99 = np.percentile(samples*1000, [50, 95, 99])
+        return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+    def stats(self, gauges=True):
+        '''Everything we know about every timer (and the gauges, if measuring memory), as a dict of dicts.
+           gauges=False leaves the gauges out (some of them, like the live objects, are slow)'''
+        stats = dict()
+        for name in list(self.samples):
+            stats[name] = self.percentiles(name)
+            stats[name]['count'] = self.counts[name]
+            stats[name]['total'] = self.totals[name]
+            with self.lock:
+                allocated = np.array(self.allocated.get(name, ()))
+                retained = self.retained.get(name)
+            if allocated.size:
+                alloc_p50, alloc_p95 = np.percentile(allocated, [50, 95])
+                stats[name].update(alloc_p50=float(alloc_p50), alloc_p95=float(alloc_p95), retained=retained)
+        if self.memory and gauges:
+            for name, function in list(self.gauges.items()):
+                stats[name] = function()
+        return stats
+
+    def draw(self, image):
+        'Writes p50/p95/p99 of every timer (and what it allocates, if measuring memory) on the top left of image'
+        font = cv2.FONT_HERSHEY_PLAIN
+        y = 15
+        for name, stats in self.stats(gauges=False).items():
+            text = f"{name:<10}{stats['p50']:6.1f}{stats['p95']:6.1f}{stats['p99']:6.1f} ms"
+            if 'alloc_p50' in stats:
+                text += f"{stats['alloc_p50']/1e6:7.2f} MB"
+            cv2.putText(image, text, (10, y), font, 1, (0, 0, 0), 3, cv2.LINE_AA)
+            cv2.putText(image, text, (10, y), font, 1, (255, 255, 255), 1, cv2.LINE_AA)
+            y += 15
+        return image
+
+
+# Shared by every module
+timers = Timers()